@@ -7,6 +7,7 @@ from aiogram.fsm.storage.redis import RedisStorage
 from decouple import config
 
 from loggers.setup_logger import module_logger
+from middlewares.rate_limit import rate_limiter
 
 env_admins = [int(admin_id) for admin_id in config("ADMINS").split(",")]
 
@@ -14,5 +15,6 @@ module_logger("aiogram", "logs_bot", "bot.log", logging.ERROR, console=True)
 module_logger("sqlalchemy", "logs_db", "db.log", logging.ERROR)
 bot = Bot(token=config("BOT_TOKEN"), default=DefaultBotProperties(parse_mode=ParseMode.HTML,
                                                                   link_preview_is_disabled=True))
+bot.session.middleware(rate_limiter)
 redis_storage = RedisStorage.from_url(config("REDIS_URL"))
 dp = Dispatcher(storage=redis_storage)
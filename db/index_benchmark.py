@@ -0,0 +1,144 @@
+"""
+Query plans and latencies of the scheduler and admin queries on a seeded Giveaways table,
+without and with the indexes added in migration 3f1c9a7d2b64.
+
+Everything is created in a separate schema that is dropped afterwards:
+
+    python -m db.index_benchmark [rows]
+
+BENCHMARK_DB_URL overrides DB_URL.
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+from decouple import config
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from db.pg_models import Base, Giveaway
+
+schema = "index_benchmark"
+repeats = 20
+
+# Индексы, которых не было до миграции, и индексы, которые она удаляет
+new_indexes = ["idx_giveaway_user_id_id", "idx_giveaway_pending_post", "idx_giveaway_pending_end",
+               "idx_giveaway_published_participants", "idx_giveaway_finished_participants",
+               "idx_giveaway_sponsor_channel_ids"]
+legacy_indexes = {
+    "idx_giveaway_id": 'CREATE INDEX idx_giveaway_id ON "Giveaways" (id)',
+    "idx_giveaway_user_id": 'CREATE INDEX idx_giveaway_user_id ON "Giveaways" (user_id)',
+    "idx_giveaway_post_datetime": 'CREATE INDEX idx_giveaway_post_datetime ON "Giveaways" (post_datetime)',
+}
+
+# Те же запросы, что строят функции из pg_orm_query
+queries = {
+    "orm_get_pending_giveaways": (
+        'SELECT id, status, post_datetime, end_datetime FROM "Giveaways" '
+        "WHERE status = 'NOT_PUBLISHED' OR (status = 'PUBLISHED' AND end_datetime IS NOT NULL)"
+    ),
+    "orm_get_published_giveaways": (
+        'SELECT id, channel_id, message_id, button FROM "Giveaways" WHERE status = \'PUBLISHED\''
+    ),
+    "orm_get_active_giveaways_w_participants": (
+        'SELECT id FROM "Giveaways" WHERE status = \'PUBLISHED\' ORDER BY participants_count DESC'
+    ),
+    "orm_get_top_giveaways_by_participants": (
+        'SELECT id, participants_count, user_id FROM "Giveaways" WHERE status = \'FINISHED\' '
+        "ORDER BY participants_count DESC LIMIT 10"
+    ),
+    "sponsor channel, = ANY (old)": (
+        'SELECT id FROM "Giveaways" WHERE -1000000000123 = ANY (sponsor_channel_ids)'
+    ),
+    "sponsor channel, @> (new)": (
+        'SELECT id FROM "Giveaways" WHERE sponsor_channel_ids @> ARRAY[-1000000000123]::bigint[]'
+    ),
+    "orm_get_user_giveaways": (
+        'SELECT id, left(text, 35), status FROM "Giveaways" WHERE user_id = 4242 ORDER BY id DESC'
+    ),
+}
+
+seed_users = """
+INSERT INTO "Users" (user_id, name, is_admin, mailing, created, updated)
+SELECT g, 'user ' || g, false, true, now(), now() FROM generate_series(1, :users) g
+"""
+
+# 2% неопубликованных, 3% активных, остальные завершены; у каждого розыгрыша два канала-спонсора из 50 000
+seed_giveaways = """
+INSERT INTO "Giveaways" (text, winners_count, channel_id, post_datetime, end_datetime, captcha,
+                         sponsor_channel_ids, participants_count, status, user_id, created, updated)
+SELECT 'giveaway ' || g, 1, -1000000000000 - g % 50000,
+       now() + (g % 1000) * interval '1 minute',
+       CASE WHEN g % 3 = 0 THEN NULL ELSE now() + (g % 5000) * interval '1 minute' END,
+       false,
+       ARRAY[-1000000000000 - g % 50000, -1000000000000 - (g * 7) % 50000]::bigint[],
+       (random() * 100000)::int,
+       (CASE WHEN g % 100 < 2 THEN 'NOT_PUBLISHED' WHEN g % 100 < 5 THEN 'PUBLISHED'
+             ELSE 'FINISHED' END)::giveawaystatus,
+       1 + g % :users, now(), now()
+FROM generate_series(1, :rows) g
+"""
+
+
+async def measure(conn) -> dict[str, tuple[list[str], float]]:
+    results = {}
+    for name, query in queries.items():
+        plan = [row[0] for row in await conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {query}"))]
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            await conn.execute(text(query))
+            timings.append((time.perf_counter() - started) * 1000)
+        results[name] = (plan, statistics.median(timings))
+    return results
+
+
+async def main(rows: int):
+    engine = create_async_engine(
+        config("BENCHMARK_DB_URL", default=config("DB_URL")),
+        connect_args={"server_settings": {"search_path": schema}},
+    )
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP SCHEMA IF EXISTS {schema} CASCADE"))
+            await conn.execute(text(f"CREATE SCHEMA {schema}"))
+            await conn.run_sync(Base.metadata.create_all)
+            for name in new_indexes:
+                await conn.execute(text(f"DROP INDEX {name}"))
+            for ddl in legacy_indexes.values():
+                await conn.execute(text(ddl))
+            print(f"Seeding {rows} giveaways...")
+            await conn.execute(text(seed_users), {"users": 10000})
+            await conn.execute(text(seed_giveaways), {"users": 10000, "rows": rows})
+
+        async with engine.connect() as conn:
+            await conn.execute(text("ANALYZE"))
+            before = await measure(conn)
+
+        async with engine.begin() as conn:
+            for name in legacy_indexes:
+                await conn.execute(text(f"DROP INDEX {name}"))
+            for index in Giveaway.__table__.indexes:
+                if index.name in new_indexes:
+                    await conn.run_sync(index.create)
+
+        async with engine.connect() as conn:
+            await conn.execute(text("ANALYZE"))
+            after = await measure(conn)
+
+        for name in queries:
+            (plan_before, ms_before), (plan_after, ms_after) = before[name], after[name]
+            print(f"\n=== {name}: {ms_before:.2f} ms -> {ms_after:.2f} ms")
+            print("--- before")
+            print("\n".join(plan_before))
+            print("--- after")
+            print("\n".join(plan_after))
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP SCHEMA IF EXISTS {schema} CASCADE"))
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000))
@@ -0,0 +1,70 @@
+"""giveaway query indexes
+
+Revision ID: 3f1c9a7d2b64
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c9a7d2b64'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Tables are created by create_db() on startup, so every step must be safe on a fresh database too.
+    # CONCURRENTLY keeps the table writable while the indexes are built and cannot run inside a transaction.
+    with op.get_context().autocommit_block():
+        op.create_index('idx_giveaway_user_id_id', 'Giveaways', ['user_id', 'id'],
+                        if_not_exists=True, postgresql_concurrently=True)
+        op.create_index('idx_giveaway_pending_post', 'Giveaways', ['post_datetime'],
+                        postgresql_where=sa.text("status = 'NOT_PUBLISHED'"),
+                        if_not_exists=True, postgresql_concurrently=True)
+        op.create_index('idx_giveaway_pending_end', 'Giveaways', ['end_datetime'],
+                        postgresql_where=sa.text("status = 'PUBLISHED' AND end_datetime IS NOT NULL"),
+                        if_not_exists=True, postgresql_concurrently=True)
+        op.create_index('idx_giveaway_published_participants', 'Giveaways', [sa.text('participants_count DESC')],
+                        postgresql_include=['id'], postgresql_where=sa.text("status = 'PUBLISHED'"),
+                        if_not_exists=True, postgresql_concurrently=True)
+        op.create_index('idx_giveaway_finished_participants', 'Giveaways', [sa.text('participants_count DESC')],
+                        postgresql_include=['id', 'user_id'], postgresql_where=sa.text("status = 'FINISHED'"),
+                        if_not_exists=True, postgresql_concurrently=True)
+        op.create_index('idx_giveaway_sponsor_channel_ids', 'Giveaways', ['sponsor_channel_ids'],
+                        postgresql_using='gin', if_not_exists=True, postgresql_concurrently=True)
+
+        # Duplicates of the primary key / unique constraint indexes and indexes replaced by the ones above
+        op.drop_index('idx_giveaway_id', 'Giveaways', if_exists=True, postgresql_concurrently=True)
+        op.drop_index('idx_giveaway_user_id', 'Giveaways', if_exists=True, postgresql_concurrently=True)
+        op.drop_index('idx_giveaway_post_datetime', 'Giveaways', if_exists=True, postgresql_concurrently=True)
+        op.drop_index('idx_user_user_id', 'Users', if_exists=True, postgresql_concurrently=True)
+        op.drop_index('idx_channel_channel_id', 'Channels', if_exists=True, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('idx_channel_channel_id', 'Channels', ['channel_id'],
+                        if_not_exists=True, postgresql_concurrently=True)
+        op.create_index('idx_user_user_id', 'Users', ['user_id'],
+                        if_not_exists=True, postgresql_concurrently=True)
+        op.create_index('idx_giveaway_post_datetime', 'Giveaways', ['post_datetime'],
+                        if_not_exists=True, postgresql_concurrently=True)
+        op.create_index('idx_giveaway_user_id', 'Giveaways', ['user_id'],
+                        if_not_exists=True, postgresql_concurrently=True)
+        op.create_index('idx_giveaway_id', 'Giveaways', ['id'],
+                        if_not_exists=True, postgresql_concurrently=True)
+
+        op.drop_index('idx_giveaway_sponsor_channel_ids', 'Giveaways', if_exists=True, postgresql_concurrently=True)
+        op.drop_index('idx_giveaway_finished_participants', 'Giveaways', if_exists=True,
+                      postgresql_concurrently=True)
+        op.drop_index('idx_giveaway_published_participants', 'Giveaways', if_exists=True,
+                      postgresql_concurrently=True)
+        op.drop_index('idx_giveaway_pending_end', 'Giveaways', if_exists=True, postgresql_concurrently=True)
+        op.drop_index('idx_giveaway_pending_post', 'Giveaways', if_exists=True, postgresql_concurrently=True)
+        op.drop_index('idx_giveaway_user_id_id', 'Giveaways', if_exists=True, postgresql_concurrently=True)
@@ -1,13 +1,110 @@
+import inspect
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
+
 from decouple import config
+from sqlalchemy import exc
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from db.pg_models import Base
 
-engine = create_async_engine(url=config("DB_URL"))
+pool_size = config("DB_POOL_SIZE", default=10, cast=int)
+pool_max_overflow = config("DB_MAX_OVERFLOW", default=20, cast=int)
+# Сколько секунд ждать свободное соединение, прежде чем упасть с ошибкой
+pool_timeout = config("DB_POOL_TIMEOUT", default=30, cast=float)
+pool_recycle = config("DB_POOL_RECYCLE", default=1800, cast=int)
+pool_pre_ping = config("DB_POOL_PRE_PING", default=True, cast=bool)
+# 0 отключает кэш подготовленных запросов (нужно за pgbouncer в режиме transaction)
+statement_cache_size = config("DB_STATEMENT_CACHE_SIZE", default=100, cast=int)
+statement_timeout = config("DB_STATEMENT_TIMEOUT", default=30000, cast=int)
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_checked_out = 0
+
+    @property
+    def avg_wait(self) -> float:
+        return self.total_wait / self.checkouts if self.checkouts else 0.0
+
+
+pool_stats = PoolStats()
+
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long checkouts wait for a connection and how close the pool gets to its limit."""
+
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.timeouts += 1
+            raise
+        waited = time.monotonic() - started
+        pool_stats.checkouts += 1
+        pool_stats.total_wait += waited
+        pool_stats.max_wait = max(pool_stats.max_wait, waited)
+        pool_stats.max_checked_out = max(pool_stats.max_checked_out, self.checkedout())
+        return connection
+
+
+engine = create_async_engine(
+    url=config("DB_URL"),
+    poolclass=MeteredPool,
+    pool_size=pool_size,
+    max_overflow=pool_max_overflow,
+    pool_timeout=pool_timeout,
+    pool_recycle=pool_recycle,
+    pool_pre_ping=pool_pre_ping,
+    connect_args={
+        "prepared_statement_cache_size": statement_cache_size,
+        "statement_cache_size": statement_cache_size,
+        "server_settings": {"statement_timeout": str(statement_timeout)},
+    },
+)
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
 
+def after_commit(session: AsyncSession, hook: Callable):
+    """Registers a side effect (cache invalidation, timers) that must run only once the transaction is committed."""
+    session.info.setdefault("after_commit", []).append(hook)
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[AsyncSession]:
+    """
+    One session and one transaction for a handler or a job: orm_* helpers only flush,
+    the transaction is committed on exit or rolled back on error.
+    """
+    async with session_maker() as session:
+        try:
+            yield session
+            await session.commit()
+        except BaseException:
+            await session.rollback()
+            raise
+        finally:
+            hooks = session.info.pop("after_commit", [])
+    for hook in hooks:
+        result = hook()
+        if inspect.isawaitable(result):
+            await result
+
+
+# Занятые соединения, свободные соединения и предел пула (pool_size + max_overflow)
+def pool_status() -> tuple[int, int, int]:
+    pool = engine.sync_engine.pool
+    return pool.checkedout(), pool.checkedin(), pool_size + pool_max_overflow
+
+
 async def create_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
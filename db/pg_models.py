@@ -1,7 +1,8 @@
 import enum
 
-from sqlalchemy import BigInteger, String, Boolean, DateTime, func, ForeignKey, Table, Column, Text, Integer, ARRAY, \
-    Enum, Index
+from sqlalchemy import BigInteger, String, Boolean, DateTime, func, ForeignKey, Table, Column, Text, Integer, Enum, \
+    Index, text as sql_text
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -38,7 +39,6 @@ class User(Base):
     )
 
     __table_args__ = (
-        Index('idx_user_user_id', 'user_id'),
         Index('idx_user_mailing', 'mailing'),
     )
 
@@ -55,10 +55,6 @@ class Channel(Base):
         back_populates="channels"
     )
 
-    __table_args__ = (
-        Index('idx_channel_channel_id', 'channel_id'),
-    )
-
 
 class GiveawayStatus(enum.Enum):
     NOT_PUBLISHED = "Not published"
@@ -91,8 +87,20 @@ class Giveaway(Base):
     creator: Mapped["User"] = relationship("User", back_populates="giveaways")
 
     __table_args__ = (
-        Index('idx_giveaway_user_id', 'user_id'),
-        Index('idx_giveaway_id', 'id'),
+        Index('idx_giveaway_user_id_id', 'user_id', 'id'),
         Index('idx_giveaway_status', 'status'),
-        Index('idx_giveaway_post_datetime', 'post_datetime'),
+        # Scheduler timers: unpublished giveaways by post time, published ones by end time
+        Index('idx_giveaway_pending_post', 'post_datetime',
+              postgresql_where=sql_text("status = 'NOT_PUBLISHED'")),
+        Index('idx_giveaway_pending_end', 'end_datetime',
+              postgresql_where=sql_text("status = 'PUBLISHED' AND end_datetime IS NOT NULL")),
+        # Active and top finished giveaways by participants; INCLUDE lets them qualify for index-only scans
+        Index('idx_giveaway_published_participants', sql_text("participants_count DESC"),
+              postgresql_include=['id'],
+              postgresql_where=sql_text("status = 'PUBLISHED'")),
+        Index('idx_giveaway_finished_participants', sql_text("participants_count DESC"),
+              postgresql_include=['id', 'user_id'],
+              postgresql_where=sql_text("status = 'FINISHED'")),
+        # Giveaways by sponsor channel (sponsor_channel_ids @> ARRAY[...])
+        Index('idx_giveaway_sponsor_channel_ids', 'sponsor_channel_ids', postgresql_using='gin'),
     )
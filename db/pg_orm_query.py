@@ -1,49 +1,58 @@
 from datetime import datetime
-from typing import Optional
+from typing import NamedTuple, Optional
 
 from sqlalchemy import select, func, update, insert, delete, any_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from db.pg_models import User, Channel, user_channel_association, Giveaway, GiveawayStatus
-from tools.logs_channel import send_log
 
 
-async def orm_user_start(session: AsyncSession, data: dict):
-    obj = User(
-        user_id=data.get("user_id"),
-        username=data.get("username"),
-        name=data.get("name"),
+class GiveawayInfo(NamedTuple):
+    """Fields of a giveaway needed on hot paths (joins, button refresh), without the post text and media."""
+    id: int
+    status: GiveawayStatus
+    user_id: int
+    channel_id: int
+    message_id: Optional[int]
+    post_url: Optional[str]
+    button: Optional[str]
+    sponsor_channel_ids: Optional[list[int]]
+    captcha: bool
+    end_count: Optional[int]
+    winners_count: int
+
+
+# Один запрос вместо проверки и вставки: новый пользователь добавляется, у известного обновляются username и имя.
+# Вернувшемуся пользователю (рассылка была отключена после блокировки бота) рассылка снова включается
+async def orm_upsert_user(session: AsyncSession, user_id: int, username: Optional[str], name: str):
+    query = pg_insert(User).values(user_id=user_id, username=username, name=name)
+    query = query.on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={"username": query.excluded.username, "name": query.excluded.name, "mailing": True,
+              "updated": func.now()},
+        where=User.username.is_distinct_from(query.excluded.username) | (User.name != query.excluded.name)
+        | User.mailing.is_(False),
     )
-    session.add(obj)
-    await session.commit()
-    await session.close()
-
-
-async def orm_get_user_data(session: AsyncSession, user_id: int):
-    query = select(User).where(User.user_id == user_id)
-    result = await session.execute(query)
-    await session.close()
-    return result.scalar()
+    await session.execute(query)
+    await session.flush()
 
 
 async def orm_count_users(session: AsyncSession):
     query = select(func.count(User.user_id))
     result = await session.execute(query)
-    await session.close()
     return result.scalar()
 
 
 async def orm_get_all_users(session: AsyncSession):
     query = select(User).order_by(User.id)
     result = await session.execute(query)
-    await session.close()
     return result.scalars().all()
 
 
 async def orm_get_last_10_users(session: AsyncSession):
     query = select(User).order_by(User.id.desc()).limit(10)
     result = await session.execute(query)
-    await session.close()
     return result.scalars().all()
 
 
@@ -54,36 +63,48 @@ async def orm_mailing_change(session: AsyncSession, user_id: int, mailing: bool)
         .values(mailing=mailing)
     )
     await session.execute(query)
-    await session.commit()
-    await session.close()
+    await session.flush()
+
+
+# Отключает рассылку сразу для пачки пользователей, возвращает количество реально изменённых строк
+async def orm_mailing_off_bulk(session: AsyncSession, user_ids: list[int]) -> int:
+    query = (
+        update(User)
+        .where(User.user_id == any_(user_ids), User.mailing == True)
+        .values(mailing=False)
+    )
+    result = await session.execute(query)
+    await session.flush()
+    return result.rowcount
 
 
 async def orm_mailing_status(session: AsyncSession, user_id: int):
     query = select(User.mailing).where(User.user_id == user_id)
     result = await session.execute(query)
-    await session.close()
     return result.scalar()
 
 
-async def orm_get_mailing_list(session: AsyncSession):
-    query = select(User.user_id).where(User.mailing == True)
-    result = await session.execute(query)
-    await session.close()
-    return result.scalars().all()
+# Получатели рассылки читаются серверным курсором пачками по chunk_size, без загрузки всей таблицы в память
+async def orm_stream_mailing_list(session: AsyncSession, chunk_size: int = 1000):
+    query = select(User.user_id).where(User.mailing == True).execution_options(yield_per=chunk_size)
+    result = await session.stream_scalars(query)
+    try:
+        async for chunk in result.partitions(chunk_size):
+            yield list(chunk)
+    finally:
+        await result.close()
 
 
 async def orm_not_mailing_users_count(session: AsyncSession):
     query = select(func.count(User.id)).where(User.mailing == False)
     result = await session.execute(query)
-    await session.close()
     return result.scalar()
 
 
 async def orm_add_channel(session: AsyncSession, channel_id: int):
     obj = Channel(channel_id=channel_id)
     session.add(obj)
-    await session.commit()
-    await session.close()
+    await session.flush()
 
 
 async def orm_delete_channel(session: AsyncSession, channel_id: int):
@@ -95,14 +116,12 @@ async def orm_delete_channel(session: AsyncSession, channel_id: int):
     await session.execute(
         delete(Channel).where(Channel.channel_id == channel_id)
     )
-    await session.commit()
-    await session.close()
+    await session.flush()
 
 
 async def orm_get_channels_for_admin(session: AsyncSession, admin_user_id: int):
     query = select(Channel).join(user_channel_association).where(user_channel_association.c.user_id == admin_user_id)
     result = await session.execute(query)
-    await session.close()
     return result.scalars().all()
 
 
@@ -112,105 +131,93 @@ async def orm_add_admin_to_channel(session: AsyncSession, user_id: int, channel_
         .values(user_id=user_id, channel_id=channel_id)
     )
     await session.execute(query)
-    await session.commit()
-    await session.close()
+    await session.flush()
 
 
 async def orm_get_admins(session: AsyncSession):
     query = select(User).where(User.is_admin == True)
     result = await session.execute(query)
-    await session.close()
     return result.scalars().all()
 
 
 async def orm_get_admins_id(session: AsyncSession):
     query = select(User.user_id).where(User.is_admin == True)
     result = await session.execute(query)
-    await session.close()
     return result.scalars().all()
 
 
 async def orm_add_admin(session: AsyncSession, user_id: int):
     query = update(User).where(User.user_id == user_id).values(is_admin=True)
     await session.execute(query)
-    await session.commit()
-    await session.close()
+    await session.flush()
 
 
 async def orm_delete_admin(session: AsyncSession, user_id: int):
     query = update(User).where(User.user_id == user_id).values(is_admin=False)
     await session.execute(query)
-    await session.commit()
-    await session.close()
+    await session.flush()
 
 
 async def orm_get_required_channels(session: AsyncSession):
     query = select(Channel).where(Channel.is_required == True)
     result = await session.execute(query)
-    await session.close()
     return result.scalars().all()
 
 
 async def orm_change_required_channel(session: AsyncSession, channel_id: int, required: bool):
     query = update(Channel).where(Channel.channel_id == channel_id).values(is_required=required)
     await session.execute(query)
-    await session.commit()
-    await session.close()
+    await session.flush()
 
 
 async def orm_is_required_channel(session: AsyncSession, channel_id: int) -> bool:
     query = select(Channel.is_required).where(Channel.channel_id == channel_id)
     result = await session.execute(query)
-    await session.close()
     return result.scalar()
 
 
 async def orm_create_giveaway(session, data, user_id):
-    try:
-        end_datetime_str = data.get('end_datetime')
-        if isinstance(end_datetime_str, str):
-            end_datetime = datetime.fromisoformat(end_datetime_str)
-        else:
-            end_datetime = None
-
-        post_datetime_str = data.get('post_datetime')
-        post_datetime = datetime.fromisoformat(post_datetime_str)
-
-        new_giveaway = Giveaway(
-            media_type=data.get('media_type'),
-            media=data.get('media'),
-            text=data.get('text'),
-            button=data.get('button'),
-            winners_count=data.get('winners_count'),
-            channel_id=data.get('channel_id'),
-            post_datetime=post_datetime,
-            end_datetime=end_datetime,
-            end_count=data.get('end_count'),
-            captcha=data.get('captcha', False),
-            extra_conditions=data.get('extra_conditions'),
-            sponsor_channel_ids=data.get('sponsor_channels', []),
-            post_url=data.get('post_url'),
-            participants_count=data.get('participants_count', 0),
-            winner_ids=data.get('winner_ids', []),
-            status='NOT_PUBLISHED',
-            user_id=user_id
-        )
-        session.add(new_giveaway)
-        await session.commit()
-    except Exception as e:
-        await send_log(f"Error creating giveaway(pg_orm_query.py:167): {e}")
-        await session.rollback()
+    end_datetime_str = data.get('end_datetime')
+    if isinstance(end_datetime_str, str):
+        end_datetime = datetime.fromisoformat(end_datetime_str)
+    else:
+        end_datetime = None
+
+    post_datetime_str = data.get('post_datetime')
+    post_datetime = datetime.fromisoformat(post_datetime_str)
+
+    new_giveaway = Giveaway(
+        media_type=data.get('media_type'),
+        media=data.get('media'),
+        text=data.get('text'),
+        button=data.get('button'),
+        winners_count=data.get('winners_count'),
+        channel_id=data.get('channel_id'),
+        post_datetime=post_datetime,
+        end_datetime=end_datetime,
+        end_count=data.get('end_count'),
+        captcha=data.get('captcha', False),
+        extra_conditions=data.get('extra_conditions'),
+        sponsor_channel_ids=data.get('sponsor_channels', []),
+        post_url=data.get('post_url'),
+        participants_count=data.get('participants_count', 0),
+        winner_ids=data.get('winner_ids', []),
+        status='NOT_PUBLISHED',
+        user_id=user_id
+    )
+    session.add(new_giveaway)
+    await session.flush()
+    return new_giveaway
 
 
 async def orm_get_user_giveaways(session: AsyncSession, user_id: int):
+    # Для списка нужно только начало текста, обрезаем его в базе
     result = await session.execute(
-        select(Giveaway.id, Giveaway.text, Giveaway.status)
+        select(Giveaway.id, func.left(Giveaway.text, 35), Giveaway.status)
         .where(Giveaway.user_id == user_id)
         .order_by(Giveaway.id.desc())
     )
-    giveaways = result.fetchall()
-    await session.close()
-    return [(row.id, row.text[:35], row.status) for row in giveaways]
+    return result.all()
 
 
 async def orm_delete_giveaway(session: AsyncSession, giveaway_id: int):
@@ -220,10 +227,8 @@ async def orm_delete_giveaway(session: AsyncSession, giveaway_id: int):
     giveaway = result.scalar_one_or_none()
     if giveaway:
         await session.delete(giveaway)
-        await session.commit()
-        await session.close()
+        await session.flush()
         return True
-    await session.close()
     return False
 
 
@@ -242,11 +247,9 @@ async def orm_update_giveaway_end_conditions(session: AsyncSession, giveaway_id:
         elif end_count:
             giveaway.end_count = end_count
             giveaway.end_datetime = None
-        await session.commit()
-        await session.close()
-        return True
-    await session.close()
-    return False
+        await session.flush()
+        return giveaway
+    return None
 
 
 async def orm_get_giveaway_by_id(session: AsyncSession, giveaway_id: int):
@@ -254,59 +257,55 @@ async def orm_get_giveaway_by_id(session: AsyncSession, giveaway_id: int):
         select(Giveaway).where(Giveaway.id == giveaway_id)
     )
     giveaway = result.scalar_one_or_none()
-    await session.close()
     return giveaway
 
 
-async def orm_add_winners(session: AsyncSession, giveaway_id: int, new_winners: list[int]):
-    async with session.begin():
-        result = await session.execute(
-            select(Giveaway).where(Giveaway.id == giveaway_id)
-        )
-        giveaway = result.scalar_one_or_none()
-        if giveaway:
-            # Объединяем текущий список победителей с новыми победителями
-            current_winners = giveaway.winner_ids or []
-            updated_winners = current_winners + new_winners
-
-            # Обновляем запись в базе данных
-            await session.execute(
-                update(Giveaway).where(Giveaway.id == giveaway_id).values(winner_ids=updated_winners)
-            )
-            return True
-    return False
+# Облегчённые данные розыгрыша прямо из базы, без текста и медиа поста
+async def orm_get_giveaway_summary(session: AsyncSession, giveaway_id: int) -> Optional[GiveawayInfo]:
+    result = await session.execute(
+        select(*(getattr(Giveaway, field) for field in GiveawayInfo._fields)).where(Giveaway.id == giveaway_id)
+    )
+    row = result.one_or_none()
+    return GiveawayInfo(*row) if row else None
 
 
-# Needed for joining mechanism
-async def orm_get_join_giveaway_data(session: AsyncSession, giveaway_id: int):
+async def orm_add_winners(session: AsyncSession, giveaway_id: int, new_winners: list[int]):
     result = await session.execute(
-        select(Giveaway.sponsor_channel_ids, Giveaway.captcha, Giveaway.status, Giveaway.end_count)
-        .where(Giveaway.id == giveaway_id)
+        select(Giveaway).where(Giveaway.id == giveaway_id)
     )
-    giveaway = result.one_or_none()
-    await session.close()
+    giveaway = result.scalar_one_or_none()
     if giveaway:
-        sponsor_channel_ids, captcha, status, end_count = giveaway
-        if status == GiveawayStatus.PUBLISHED:
-            return sponsor_channel_ids, captcha, end_count
-    return None, None, None
+        # Объединяем текущий список победителей с новыми победителями
+        current_winners = giveaway.winner_ids or []
+        updated_winners = current_winners + new_winners
+
+        # Обновляем запись в базе данных
+        await session.execute(
+            update(Giveaway).where(Giveaway.id == giveaway_id).values(winner_ids=updated_winners)
+        )
+        return True
+    return False
 
 
-async def orm_get_due_giveaways(session: AsyncSession, current_time: datetime):
+# Needed for loading scheduler timers on startup
+async def orm_get_pending_giveaways(session: AsyncSession):
     result = await session.execute(
-        select(Giveaway).where(
-            (Giveaway.post_datetime <= current_time) |
-            (Giveaway.end_datetime <= current_time) |
-            (Giveaway.end_count.is_not(None))
+        select(Giveaway.id, Giveaway.status, Giveaway.post_datetime, Giveaway.end_datetime).where(
+            (Giveaway.status == GiveawayStatus.NOT_PUBLISHED) |
+            ((Giveaway.status == GiveawayStatus.PUBLISHED) & Giveaway.end_datetime.is_not(None))
         )
     )
-    giveaways = result.scalars().all()
-    await session.close()
+    pending = result.all()
+    return pending
 
-    not_published = [giveaway for giveaway in giveaways if giveaway.status == GiveawayStatus.NOT_PUBLISHED]
-    ready_for_results = [giveaway for giveaway in giveaways if giveaway.status == GiveawayStatus.PUBLISHED]
 
-    return not_published, ready_for_results
+async def orm_get_published_giveaways(session: AsyncSession):
+    result = await session.execute(
+        select(Giveaway.id, Giveaway.channel_id, Giveaway.message_id, Giveaway.button)
+        .where(Giveaway.status == GiveawayStatus.PUBLISHED)
+    )
+    published = result.all()
+    return published
 
 
 async def orm_update_giveaway_status(session: AsyncSession, giveaway_id: int, status: GiveawayStatus,
@@ -319,10 +318,8 @@ async def orm_update_giveaway_status(session: AsyncSession, giveaway_id: int, st
         giveaway.status = status
         if participants_count is not None:
             giveaway.participants_count = participants_count
-        await session.commit()
-        await session.close()
+        await session.flush()
         return True
-    await session.close()
     return False
 
 
@@ -334,29 +331,16 @@ async def orm_update_giveaway_post_data(session: AsyncSession, giveaway_id: int,
     if giveaway:
         giveaway.post_url = post_url
         giveaway.message_id = message_id
-        await session.commit()
-        await session.close()
+        await session.flush()
         return True
-    await session.close()
     return False
 
 
-async def orm_get_giveaway_end_count(session: AsyncSession, giveaway_id: int) -> Optional[int]:
-    result = await session.execute(
-        select(Giveaway.end_count).where(Giveaway.id == giveaway_id)
-    )
-    end_count = result.scalar_one_or_none()
-    await session.close()
-    if end_count is None:
-        return None
-    return int(end_count)
-
-
 async def orm_update_participants_count(session: AsyncSession, giveaway_id: int, participants_count: int):
     await session.execute(
         update(Giveaway).where(Giveaway.id == giveaway_id).values(participants_count=participants_count)
     )
-    await session.commit()
+    await session.flush()
 
 
 async def orm_get_users_with_giveaways(session: AsyncSession):
@@ -372,28 +356,26 @@ async def orm_get_users_with_giveaways(session: AsyncSession):
 
 async def orm_get_giveaways_by_sponsor_channel_id(session: AsyncSession, channel_id: int):
     result = await session.execute(
-        select(Giveaway.id).where(channel_id == any_(Giveaway.sponsor_channel_ids))
+        select(Giveaway.id).where(Giveaway.sponsor_channel_ids.contains([channel_id]))
     )
     giveaway_ids = result.scalars().all()
-    await session.close()
     return giveaway_ids
 
 
 async def orm_get_top_giveaways_by_participants(session: AsyncSession):
+    # Только столбцы из idx_giveaway_finished_participants: запрос читает один индекс
     result = await session.execute(
-        select(Giveaway).where(Giveaway.status == GiveawayStatus.FINISHED)
+        select(Giveaway.id, Giveaway.participants_count, Giveaway.user_id)
+        .where(Giveaway.status == GiveawayStatus.FINISHED)
         .order_by(Giveaway.participants_count.desc())
         .limit(10)
     )
-    top_giveaways = result.scalars().all()
-    await session.close()
-    return top_giveaways
+    return result.all()
 
 
 async def orm_get_last_giveaway_id(session: AsyncSession) -> int:
     query = select(Giveaway.id).order_by(Giveaway.id.desc()).limit(1)
     result = await session.execute(query)
-    await session.close()
     return int(result.scalar_one_or_none())
 
 
@@ -403,7 +385,6 @@ async def orm_get_active_giveaways_w_participants(session: AsyncSession):
         .order_by(Giveaway.participants_count.desc())
     )
     active_giveaways = result.scalars().all()
-    await session.close()
     return active_giveaways
 
 
@@ -412,7 +393,6 @@ async def orm_get_user_id_by_giveaway_id(session: AsyncSession, giveaway_id: int
         select(Giveaway.user_id).where(Giveaway.id == giveaway_id)
     )
     user_id = result.scalar_one_or_none()
-    await session.close()
     return user_id
 
 
@@ -446,4 +426,4 @@ async def orm_delete_sponsor(session: AsyncSession, giveaway_id: int, sponsor_ch
         sponsor_channel_ids=func.array_remove(Giveaway.sponsor_channel_ids, sponsor_channel_id)
     )
     await session.execute(query)
-    await session.commit()
+    await session.flush()
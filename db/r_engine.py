@@ -1,7 +1,12 @@
+import os
+import socket
+import uuid
+
 from decouple import config
 import redis
 
 redis_url = config("REDIS_URL")
 redis_conn = redis.asyncio.Redis.from_url(redis_url, decode_responses=True)
 
-
+# Уникальный идентификатор процесса, владельца блокировок и лидерства в Redis
+instance_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
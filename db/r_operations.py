@@ -1,5 +1,10 @@
 import json
-from datetime import datetime, timedelta, timezone
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+
+import pytz
+from redis.exceptions import ResponseError
 
 from db.r_engine import redis_conn
 
@@ -35,14 +40,70 @@ async def redis_set_mailing_users(users):
     await redis_conn.sadd("users_for_mailing", *users)
 
 
-async def redis_get_mailing_users():
-    users = await redis_conn.smembers("users_for_mailing")
-    return set(users)
+async def redis_get_mailing_users_count() -> int:
+    return await redis_conn.scard("users_for_mailing")
+
+
+# Взятые в работу получатели переносятся в users_for_mailing:inflight до записи чекпоинта
+_pop_mailing_script = redis_conn.register_script("""
+local users = redis.call('SPOP', KEYS[1], ARGV[1])
+if #users > 0 then
+    redis.call('SADD', KEYS[2], unpack(users))
+end
+return users
+""")
+
+
+async def redis_pop_mailing_users(count: int) -> list[int]:
+    users = await _pop_mailing_script(keys=["users_for_mailing", "users_for_mailing:inflight"], args=[count])
+    return [int(user) for user in users]
+
+
+# Возвращает в очередь получателей, взятых в работу до перезапуска
+async def redis_restore_mailing_users():
+    if await redis_conn.exists("users_for_mailing:inflight"):
+        async with redis_conn.pipeline(transaction=True) as pipe:
+            pipe.sunionstore("users_for_mailing", ["users_for_mailing", "users_for_mailing:inflight"])
+            pipe.delete("users_for_mailing:inflight")
+            await pipe.execute()
+
+
+# Статистика живёт без TTL до redis_finish_mailing_stats: по ней рассылка продолжается после перезапуска
+async def redis_start_mailing_stats(total: int) -> dict:
+    stats = {"total": total, "success": 0, "notsuccess": 0, "blocked": 0, "reclaimed": 0,
+             "started": int(time.time())}
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.delete("mailing_stats")
+        pipe.hset("mailing_stats", mapping=stats)
+        await pipe.execute()
+    return stats
+
+
+async def redis_get_mailing_stats() -> dict:
+    stats = await redis_conn.hgetall("mailing_stats")
+    return {key: int(value) for key, value in stats.items()}
+
+
+# Чекпоинт рассылки: обработанные получатели удаляются из очереди вместе с обновлением счётчиков.
+# Сообщение рассылки продлевается, пока она идёт, иначе долгую рассылку нельзя было бы продолжить
+async def redis_mailing_checkpoint(users: list, increments: dict):
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.srem("users_for_mailing:inflight", *users)
+        for key, value in increments.items():
+            if value:
+                pipe.hincrby("mailing_stats", key, value)
+        for key in ("msg_for_mailing", "msg_from", "btns_for_mailing"):
+            pipe.expire(key, 21600)
+        await pipe.execute()
 
 
-# Delete user from redis after successful mailing
-async def redis_delete_mailing_user(user):
-    await redis_conn.srem("users_for_mailing", user)
+async def redis_finish_mailing_stats():
+    await redis_conn.delete("mailing_stats")
+
+
+# Остатки рассылки, которую уже нельзя продолжить
+async def redis_clear_mailing():
+    await redis_conn.delete("mailing_stats", "users_for_mailing", "users_for_mailing:inflight")
 
 
 async def redis_set_mailing_msg(msg_id):
@@ -71,68 +132,472 @@ async def redis_get_mailing_btns():
     return btns_dict
 
 
+def _subscription_key(channel_id: int, user_id: int) -> str:
+    return f"subscription:{channel_id}:{user_id}"
+
+
+# Кэш статуса подписки: True/False, None если в кэше нет
+async def redis_get_subscriptions(channel_ids: list[int], user_id: int) -> list[Optional[bool]]:
+    values = await redis_conn.mget([_subscription_key(channel_id, user_id) for channel_id in channel_ids])
+    return [None if value is None else value == "1" for value in values]
+
+
+async def redis_set_subscription(channel_id: int, user_id: int, subscribed: bool, ttl: int):
+    await redis_conn.set(_subscription_key(channel_id, user_id), int(subscribed), ex=ttl)
+
+
+def _activity_hll_key(day: date) -> str:
+    return f"activity:hll:{day:%Y-%m-%d}"
+
+
+def _moscow_today() -> date:
+    return datetime.now(pytz.timezone('Europe/Moscow')).date()
+
+
+# Индекс активности: ZSET users_activity, user_id -> время последнего обращения к боту,
+# и HyperLogLog уникальных пользователей за каждый день (по московскому времени), хранится ~год
+async def redis_record_user_activity(activity: dict[int, int]):
+    days: dict[date, list[int]] = {}
+    for user_id, timestamp in activity.items():
+        day = datetime.fromtimestamp(timestamp, pytz.timezone('Europe/Moscow')).date()
+        days.setdefault(day, []).append(user_id)
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.zadd("users_activity", activity, gt=True)
+        for day, user_ids in days.items():
+            pipe.pfadd(_activity_hll_key(day), *user_ids)
+            pipe.expire(_activity_hll_key(day), timedelta(days=400))
+        await pipe.execute()
+
+
+# Уникальные активные пользователи за дни с start по end включительно
+async def redis_count_active_between(start: date, end: date) -> int:
+    days = (end - start).days + 1
+    if days <= 0:
+        return 0
+    return await redis_conn.pfcount(*(_activity_hll_key(start + timedelta(days=i)) for i in range(days)))
+
+
+# DAU/WAU/MAU: уникальные пользователи за последние 1, 7 и 30 дней, включая сегодняшний
+async def redis_get_dau_wau_mau() -> tuple[int, int, int]:
+    today = _moscow_today()
+    return (await redis_count_active_between(today, today),
+            await redis_count_active_between(today - timedelta(days=6), today),
+            await redis_count_active_between(today - timedelta(days=29), today))
+
+
+# Уникальные активные пользователи по календарным месяцам: [(первое число месяца, количество)]
+async def redis_get_monthly_active(months: int = 12) -> list[tuple[datetime, int]]:
+    today = _moscow_today()
+    month_start = today.replace(day=1)
+    data = []
+    for _ in range(months):
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        count = await redis_count_active_between(month_start, min(next_month - timedelta(days=1), today))
+        data.append((datetime.combine(month_start, datetime.min.time()), count))
+        month_start = (month_start - timedelta(days=1)).replace(day=1)
+    data.reverse()
+    # Месяцы до начала сбора статистики не показываем
+    while data and not data[0][1]:
+        data.pop(0)
+    return data
+
+
+def _active_since(days: int) -> int:
+    return int((datetime.now(timezone.utc) - timedelta(days=days)).timestamp())
+
+
 async def get_active_users_count(days: int):
-    timestamp = int((datetime.now(timezone.utc) - timedelta(days=days)).timestamp())
-    active_users = 0
-    cursor = "0"
+    return await redis_conn.zcount("users_activity", f"({_active_since(days)}", "+inf")
 
-    while cursor != 0:
-        cursor, keys = await redis_conn.scan(cursor=cursor, match="user_activity:*")
-        for key in keys:
-            last_activity = await redis_conn.get(key)
-            if int(last_activity) > timestamp:
-                active_users += 1
 
-    return active_users
+# Оставляет из пачки только пользователей, активных за последние days дней
+async def redis_filter_active_users(user_ids: list[int], days: int) -> list[int]:
+    if not user_ids:
+        return []
+    since = _active_since(days)
+    last_seen = await redis_conn.zmscore("users_activity", user_ids)
+    return [user_id for user_id, seen in zip(user_ids, last_seen) if seen is not None and seen > since]
+
 
+# Одноразовый перенос старых ключей user_activity:{id} в ZSET users_activity. После полного прохода ставится
+# отметка, и следующие запуски не сканируют ключи заново
+async def redis_migrate_user_activity() -> int:
+    if await redis_conn.exists("migrations:user_activity"):
+        return 0
+    migrated = 0
+    async for key in redis_conn.scan_iter(match="user_activity:*", count=1000):
+        last_activity = await redis_conn.get(key)
+        async with redis_conn.pipeline(transaction=True) as pipe:
+            if last_activity is not None:
+                pipe.zadd("users_activity", {key.split(":", maxsplit=1)[1]: int(last_activity)}, gt=True)
+            pipe.delete(key)
+            await pipe.execute()
+        migrated += 1
+    await redis_conn.set("migrations:user_activity", int(time.time()))
+    return migrated
+
+
+def _participants_key(giveaway_id: int) -> str:
+    return f"giveaway:{giveaway_id}:participants"
+
+
+def _joined_key(giveaway_id: int) -> str:
+    return f"giveaway:{giveaway_id}:joined"
+
+
+def _end_count_key(giveaway_id: int) -> str:
+    return f"giveaway:{giveaway_id}:end_count"
+
+
+# KEYS: participants SET, joined ZSET, cached end_count, SET of giveaways waiting for results
+# ARGV: user_id, join timestamp, end_count from the caller ("" if unknown) used to warm the cache, giveaway_id
+_join_script = redis_conn.register_script("""
+local existed = redis.call('EXISTS', KEYS[1])
+local added = redis.call('SADD', KEYS[1], ARGV[1])
+if added == 1 then
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+end
+local count = redis.call('SCARD', KEYS[1])
+local end_count = redis.call('GET', KEYS[3])
+if not end_count and ARGV[3] ~= '' then
+    end_count = ARGV[3]
+    -- Кэш прогревается только у розыгрыша с уже существующими участниками и живёт не дольше их
+    if existed == 1 then
+        local ttl = redis.call('PTTL', KEYS[1])
+        if ttl > 0 then
+            redis.call('SET', KEYS[3], end_count, 'PX', ttl)
+        else
+            redis.call('SET', KEYS[3], end_count)
+        end
+    end
+end
+local end_reached = 0
+if added == 1 and end_count and count >= tonumber(end_count) then
+    -- Только первый, кто достиг end_count, запрашивает подведение итогов
+    end_reached = redis.call('SADD', KEYS[4], ARGV[4])
+end
+return {added, count, end_reached}
+""")
+
+
+# Статусы доставки уведомлений победителям: HASH giveaway:{id}:notified, user_id -> статус
+NOTIFICATION_SENT = "sent"
+NOTIFICATION_BLOCKED = "blocked"
+NOTIFICATION_ERROR = "error"
+NOTIFICATION_FAILED = "failed"
+
+
+async def redis_set_notification_status(giveaway_id: int, user_id: int, status: str):
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.hset(f"giveaway:{giveaway_id}:notified", str(user_id), status)
+        pipe.expire(f"giveaway:{giveaway_id}:notified", timedelta(days=30))
+        await pipe.execute()
+
+
+async def redis_get_notification_statuses(giveaway_id: int) -> dict[int, str]:
+    statuses = await redis_conn.hgetall(f"giveaway:{giveaway_id}:notified")
+    return {int(user_id): status for user_id, status in statuses.items()}
+
+
+# Выполненные шаги публикации и подведения итогов: HASH giveaway:{id}:progress:{stage} с JSON-значениями.
+# Повтор задачи после сбоя продолжает с первого невыполненного шага
+async def redis_get_giveaway_progress(giveaway_id: int, stage: str) -> dict:
+    progress = await redis_conn.hgetall(f"giveaway:{giveaway_id}:progress:{stage}")
+    return {field: json.loads(value) for field, value in progress.items()}
+
+
+async def redis_set_giveaway_progress(giveaway_id: int, stage: str, **fields):
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.hset(f"giveaway:{giveaway_id}:progress:{stage}",
+                  mapping={field: json.dumps(value) for field, value in fields.items()})
+        pipe.expire(f"giveaway:{giveaway_id}:progress:{stage}", timedelta(days=30))
+        await pipe.execute()
+
+
+# Кэш розыгрышей: HASH giveaway:{id}:info с JSON-значениями полей и счётчик версий giveaway:{id}:version.
+# Запись в кэш проходит, только если версия не изменилась с момента чтения из базы
+_store_giveaway_info_script = redis_conn.register_script("""
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+
+async def redis_get_giveaway_info(giveaway_id: int) -> Optional[dict]:
+    info = await redis_conn.hgetall(f"giveaway:{giveaway_id}:info")
+    return {field: json.loads(value) for field, value in info.items()} if info else None
 
-# Функция, которая создаёт словарь giveaway_id: список_айди_участников
+
+async def redis_get_giveaway_version(giveaway_id: int) -> str:
+    return await redis_conn.get(f"giveaway:{giveaway_id}:version") or "0"
+
+
+async def redis_store_giveaway_info(giveaway_id: int, info: dict, version: str, ttl: int) -> bool:
+    fields = [item for field, value in info.items() for item in (field, json.dumps(value))]
+    return bool(await _store_giveaway_info_script(
+        keys=[f"giveaway:{giveaway_id}:info", f"giveaway:{giveaway_id}:version"],
+        args=[version, ttl, *fields],
+    ))
+
+
+async def redis_invalidate_giveaway_info(giveaway_id: int):
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.incr(f"giveaway:{giveaway_id}:version")
+        pipe.expire(f"giveaway:{giveaway_id}:version", timedelta(days=30))
+        pipe.delete(f"giveaway:{giveaway_id}:info")
+        await pipe.execute()
+
+
+# Участники хранятся в SET (членство/количество) и ZSET (score = время вступления, порядок)
 async def redis_create_giveaway(giveaway_id: int):
-    await redis_conn.set(f"giveaway:{giveaway_id}", json.dumps([]))
+    await redis_conn.delete(_participants_key(giveaway_id), _joined_key(giveaway_id))
 
 
-# Функция, которая добавляет к этому словарю айди участника
-async def redis_add_participant(giveaway_id: int, user_id: int):
-    participants = await redis_conn.get(f"giveaway:{giveaway_id}")
-    if participants is None:
-        participants = []
+# Атомарное вступление за один запрос: (новый ли участник, количество участников, достигнут ли end_count)
+async def redis_join_giveaway(giveaway_id: int, user_id: int,
+                              end_count: Optional[int] = None) -> tuple[bool, int, bool]:
+    added, count, end_reached = await _join_script(
+        keys=[_participants_key(giveaway_id), _joined_key(giveaway_id), _end_count_key(giveaway_id),
+              "giveaways:finalize"],
+        args=[user_id, time.time(), end_count or "", giveaway_id],
+    )
+    return bool(added), int(count), bool(end_reached)
+
+
+async def redis_set_giveaway_end_count(giveaway_id: int, end_count: Optional[int]):
+    if end_count:
+        await redis_conn.set(_end_count_key(giveaway_id), end_count)
     else:
-        participants = json.loads(participants)
+        await redis_conn.delete(_end_count_key(giveaway_id))
+
 
-    if user_id not in participants:
-        participants.append(user_id)
-        await redis_conn.set(f"giveaway:{giveaway_id}", json.dumps(participants))
+# Розыгрыши, набравшие end_count, итоги которых ещё не подведены
+async def redis_get_finalize_requests() -> list[int]:
+    return [int(giveaway_id) for giveaway_id in await redis_conn.smembers("giveaways:finalize")]
+
+
+async def redis_clear_finalize_request(giveaway_id: int):
+    await redis_conn.srem("giveaways:finalize", giveaway_id)
+
+
+async def redis_is_participant(giveaway_id: int, user_id: int) -> bool:
+    return bool(await redis_conn.sismember(_participants_key(giveaway_id), user_id))
 
 
 # Функция, которая получает количество участников
-async def redis_get_participants_count(giveaway_id: int):
-    participants = await redis_conn.get(f"giveaway:{giveaway_id}")
-    if participants is None:
-        return 0
-    participants = json.loads(participants)
-    return len(participants)
+async def redis_get_participants_count(giveaway_id: int) -> int:
+    return await redis_conn.scard(_participants_key(giveaway_id))
 
 
-# Функция, которая получает список участников
-async def redis_get_participants(giveaway_id: int):
-    participants = await redis_conn.get(f"giveaway:{giveaway_id}")
-    if participants is None:
-        return None
-    return json.loads(participants)
+async def redis_get_participants_counts(giveaway_ids: list[int]) -> list[int]:
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        for giveaway_id in giveaway_ids:
+            pipe.scard(_participants_key(giveaway_id))
+        return await pipe.execute()
 
 
-# Функция, которая возвращает последние 20 участников розыгрыша
-async def redis_get_last_participants(giveaway_id: int):
-    key = f"giveaway:{giveaway_id}"
+# Количество участников, показанное сейчас на кнопке поста: HASH giveaway_buttons, giveaway_id -> count
+async def redis_get_rendered_counts(giveaway_ids: list[int]) -> dict[int, int]:
+    if not giveaway_ids:
+        return {}
+    counts = await redis_conn.hmget("giveaway_buttons", giveaway_ids)
+    return {giveaway_id: int(count) for giveaway_id, count in zip(giveaway_ids, counts) if count is not None}
 
-    participants_json = await redis_conn.get(key)
-    if participants_json is None:
-        return []
 
-    participants = json.loads(participants_json)  # Декодируем JSON-строку в список
-    return participants[-20:]  # Возвращаем последние 20 участников
+async def redis_set_rendered_count(giveaway_id: int, count: int):
+    await redis_conn.hset("giveaway_buttons", str(giveaway_id), count)
+
+
+async def redis_delete_rendered_counts(giveaway_ids: list[int]):
+    if giveaway_ids:
+        await redis_conn.hdel("giveaway_buttons", *map(str, giveaway_ids))
+
 
+# Функция, которая получает список участников в порядке вступления
+async def redis_get_participants(giveaway_id: int) -> list[int]:
+    participants = await redis_conn.zrange(_joined_key(giveaway_id), 0, -1)
+    return [int(user_id) for user_id in participants]
+
+
+# Функция, которая возвращает последние 20 участников розыгрыша
+async def redis_get_last_participants(giveaway_id: int) -> list[int]:
+    participants = await redis_conn.zrange(_joined_key(giveaway_id), -20, -1)
+    return [int(user_id) for user_id in participants]
 
-# Удаляет словарь с юзерами через неделю timedelta(weeks=1)
+
+# Удаляет участников через неделю timedelta(weeks=1)
 async def redis_expire_giveaway(giveaway_id: int):
-    await redis_conn.expire(f"giveaway:{giveaway_id}", timedelta(weeks=1))
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.expire(_participants_key(giveaway_id), timedelta(weeks=1))
+        pipe.expire(_joined_key(giveaway_id), timedelta(weeks=1))
+        pipe.delete(_end_count_key(giveaway_id))
+        await pipe.execute()
+
+
+# Одноразовый перенос старых JSON-списков giveaway:{id} в SET + ZSET. После полного прохода ставится отметка,
+# и следующие запуски не сканируют ключи заново
+async def redis_migrate_participants() -> int:
+    if await redis_conn.exists("migrations:participants"):
+        return 0
+    migrated = 0
+    async for key in redis_conn.scan_iter(match="giveaway:*", _type="string"):
+        _, giveaway_id = key.split(":", maxsplit=1)
+        if not giveaway_id.isdigit():
+            continue
+        participants = json.loads(await redis_conn.get(key) or "[]")
+        ttl = await redis_conn.ttl(key)
+        async with redis_conn.pipeline(transaction=True) as pipe:
+            if participants:
+                # Старые участники идут раньше любых новых: score = порядковый номер в списке
+                pipe.sadd(_participants_key(int(giveaway_id)), *participants)
+                pipe.zadd(_joined_key(int(giveaway_id)),
+                          {user_id: index for index, user_id in enumerate(participants)}, nx=True)
+                if ttl > 0:
+                    pipe.expire(_participants_key(int(giveaway_id)), ttl)
+                    pipe.expire(_joined_key(int(giveaway_id)), ttl)
+            pipe.delete(key)
+            await pipe.execute()
+        migrated += 1
+    await redis_conn.set("migrations:participants", int(time.time()))
+    return migrated
+
+
+# Лидерство: KEYS: lease, счётчик токенов; ARGV: owner, ttl в мс.
+# Новый владелец получает следующий номер лидерства, текущий владелец продлевает аренду с тем же номером
+_lease_script = redis_conn.register_script("""
+local owner = redis.call('GET', KEYS[1])
+if owner == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return tonumber(redis.call('GET', KEYS[2]))
+end
+if owner then
+    return false
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return token
+""")
+
+# Удаляет или продлевает ключ, только если он принадлежит owner. ARGV: owner, ttl в мс (0 - удалить)
+_owned_key_script = redis_conn.register_script("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '0' then
+    return redis.call('DEL', KEYS[1])
+end
+return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+""")
+
+
+async def redis_claim_lease(name: str, owner: str, ttl: float) -> Optional[int]:
+    token = await _lease_script(keys=[f"lease:{name}", f"lease:{name}:token"], args=[owner, int(ttl * 1000)])
+    return int(token) if token is not None else None
+
+
+# Токен действующего лидера, если это owner
+async def redis_get_lease_token(name: str, owner: str) -> Optional[int]:
+    current_owner, token = await redis_conn.mget([f"lease:{name}", f"lease:{name}:token"])
+    return int(token) if current_owner == owner and token is not None else None
+
+
+async def redis_release_lease(name: str, owner: str):
+    await _owned_key_script(keys=[f"lease:{name}"], args=[owner, 0])
+
+
+async def redis_acquire_lock(key: str, owner: str, ttl: float) -> bool:
+    return bool(await redis_conn.set(key, owner, nx=True, px=int(ttl * 1000)))
+
+
+async def redis_extend_lock(key: str, owner: str, ttl: float) -> bool:
+    return bool(await _owned_key_script(keys=[key], args=[owner, int(ttl * 1000)]))
+
+
+async def redis_release_lock(key: str, owner: str):
+    await _owned_key_script(keys=[key], args=[owner, 0])
+
+
+# Изменения таймеров розыгрышей рассылаются всем репликам, чтобы лидер узнал о них
+async def redis_publish_timer_changes(changes: str):
+    await redis_conn.publish("giveaway_timers", changes)
+
+
+async def redis_listen_timer_changes():
+    async with redis_conn.pubsub() as pubsub:
+        await pubsub.subscribe("giveaway_timers")
+        async for message in pubsub.listen():
+            if message["type"] == "message":
+                yield message["data"]
+
+
+# Очередь задач: поток jobs с группой исполнителей workers, отложенные повторы в ZSET jobs:delayed,
+# задачи, исчерпавшие попытки, - в потоке jobs:dead
+async def redis_create_job_group():
+    try:
+        await redis_conn.xgroup_create("jobs", "workers", id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def redis_add_job(job: str):
+    await redis_conn.xadd("jobs", {"job": job})
+
+
+async def redis_read_jobs(consumer: str, count: int = 1, block: int = 5000) -> list[tuple[str, str]]:
+    response = await redis_conn.xreadgroup("workers", consumer, {"jobs": ">"}, count=count, block=block)
+    return [(entry_id, fields["job"]) for _, entries in response or [] for entry_id, fields in entries]
+
+
+# Забирает задачи, которые другой исполнитель взял, но не подтвердил за min_idle секунд (например, упал)
+async def redis_claim_stale_jobs(consumer: str, min_idle: float, count: int = 10) -> list[tuple[str, str]]:
+    response = await redis_conn.xautoclaim("jobs", "workers", consumer, min_idle_time=int(min_idle * 1000),
+                                           start_id="0-0", count=count)
+    return [(entry_id, fields["job"]) for entry_id, fields in response[1] if fields]
+
+
+# Сбрасывает время простоя задачи, которую исполнитель ещё выполняет, чтобы её не забрал другой
+async def redis_touch_job(entry_id: str, consumer: str):
+    await redis_conn.xclaim("jobs", "workers", consumer, min_idle_time=0, message_ids=[entry_id], justid=True)
+
+
+async def redis_finish_job(entry_id: str):
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.xack("jobs", "workers", entry_id)
+        pipe.xdel("jobs", entry_id)
+        await pipe.execute()
+
+
+async def redis_retry_job(entry_id: str, job: str, retry_at: float):
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.zadd("jobs:delayed", {job: retry_at})
+        pipe.xack("jobs", "workers", entry_id)
+        pipe.xdel("jobs", entry_id)
+        await pipe.execute()
+
+
+async def redis_dead_letter_job(entry_id: str, job: str):
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.xadd("jobs:dead", {"job": job}, maxlen=10000, approximate=True)
+        pipe.xack("jobs", "workers", entry_id)
+        pipe.xdel("jobs", entry_id)
+        await pipe.execute()
+
+
+_move_due_jobs_script = redis_conn.register_script("""
+local jobs = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, job in ipairs(jobs) do
+    redis.call('ZREM', KEYS[1], job)
+    redis.call('XADD', KEYS[2], '*', 'job', job)
+end
+return #jobs
+""")
+
+
+# Возвращает в очередь задачи, время повтора которых наступило
+async def redis_move_due_jobs() -> int:
+    return await _move_due_jobs_script(keys=["jobs:delayed", "jobs"], args=[time.time()])
@@ -9,24 +9,29 @@ from aiogram.utils.chat_action import ChatActionSender
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from create_bot import bot, env_admins
-from db.pg_orm_query import orm_count_users, orm_get_mailing_list, orm_get_required_channels, orm_is_required_channel, \
-    orm_change_required_channel, orm_get_users_with_giveaways, orm_get_user_giveaways, orm_get_giveaway_by_id, \
-    orm_get_top_giveaways_by_participants, orm_get_last_giveaway_id, orm_get_active_giveaways_w_participants, \
-    orm_get_user_regs_by_month
+from db.pg_engine import pool_status, pool_stats, unit_of_work
+from db.pg_orm_query import orm_count_users, orm_stream_mailing_list, orm_get_required_channels, \
+    orm_is_required_channel, orm_change_required_channel, orm_get_users_with_giveaways, orm_get_user_giveaways, \
+    orm_get_giveaway_by_id, orm_get_top_giveaways_by_participants, orm_get_last_giveaway_id, \
+    orm_get_active_giveaways_w_participants, orm_get_user_regs_by_month
 from db.r_operations import (redis_set_mailing_users, redis_set_mailing_msg, redis_set_msg_from,
                              redis_set_mailing_btns, get_active_users_count, redis_get_participants_count,
-                             redis_get_last_participants)
+                             redis_get_last_participants, redis_filter_active_users, redis_get_dau_wau_mau,
+                             redis_get_monthly_active, redis_get_participants_counts)
 from filters.chat_type import ChatType
 from filters.is_admin import IsAdmin
 from handlers.giveaway_interaction_router import status_mapping
 from keyboards.inline import get_callback_btns
 from keyboards.reply import get_keyboard, admin_kb
+from middlewares.rate_limit import rate_limiter, Lane
+from tools.activity_buffer import activity_buffer
 from tools.giveaway_utils import get_giveaway_post
 from tools.graph import create_graph
 from tools.logs_channel import send_log
-from tools.mailing import simple_mailing, simple_mailing_test
+from tools.mailing import simple_mailing, simple_mailing_test, mailing_report_text, mailing_chunk_size
 from tools.texts import cbk_msg, format_giveaways_for_admin
-from tools.utils import msg_to_cbk, channel_info, get_user_creds
+from tools.utils import msg_to_cbk, channel_info, get_user_creds, subscription_cache, subscription_stats, \
+    get_users_creds, get_many_chats_info, chat_cache
 
 admin_private_router = Router()
 admin_private_router.message.filter(ChatType("private"), IsAdmin())
@@ -38,17 +43,16 @@ async def get_profile(message: Message, session: AsyncSession):
         count = await orm_count_users(session)
         required_channels = await orm_get_required_channels(session)
         channels_str = '\n\nОбязательные каналы для функции "Постинг":\n'
-        for channel in required_channels:
-            chat = await bot.get_chat(channel.channel_id)
-            channels_str += f"🔹<a href='{chat.invite_link}'>{chat.title}</a>\n"
+        chats = await get_many_chats_info([channel.channel_id for channel in required_channels])
+        for chat in chats.values():
+            if chat is not None:
+                channels_str += f"🔹<a href='{chat.invite_link}'>{chat.title}</a>\n"
         admin_text = (
             f"В базе данных <b>{count}</b> человек👥\n\n"
             f"Было создано <b>{await orm_get_last_giveaway_id(session)}</b> розыгрышей🎁\n\n"
         )
 
-        active_users_day = await get_active_users_count(1)
-        active_users_week = await get_active_users_count(7)
-        active_users_month = await get_active_users_count(30)
+        active_users_day, active_users_week, active_users_month = await redis_get_dau_wau_mau()
 
         admin_text += (f"Количество активных пользователей:\n👥🗓\n"
                        f"День: {active_users_day}\n"
@@ -59,6 +63,34 @@ async def get_profile(message: Message, session: AsyncSession):
     await message.answer(admin_text, reply_markup=await admin_kb())
 
 
+@admin_private_router.message(F.text == "Статистика бота")
+async def get_bot_stats(message: Message):
+    checked_out, idle, pool_limit = pool_status()
+    text = ("<b>📊 Статистика бота</b>\n\n"
+            f"<b>Кэш подписок</b>\n"
+            f"Локально: {subscription_cache.hits} попаданий / {subscription_cache.misses} промахов "
+            f"({subscription_cache.hit_rate:.0%}), записей: {len(subscription_cache)}\n"
+            f"Redis: {subscription_stats['redis_hits']} попаданий\n"
+            f"Запросов к Telegram: {subscription_stats['telegram_requests']}\n\n"
+            f"<b>Кэш чатов</b>\n"
+            f"{chat_cache.hits} попаданий / {chat_cache.misses} промахов ({chat_cache.hit_rate:.0%}), "
+            f"записей: {len(chat_cache)}/{chat_cache.maxsize}\n\n"
+            f"<b>Буфер активности</b>\n"
+            f"В буфере: {len(activity_buffer)}/{activity_buffer.maxsize}, записано: {activity_buffer.flushed}, "
+            f"отброшено: {activity_buffer.dropped}\n\n"
+            f"<b>Пул соединений PostgreSQL</b>\n"
+            f"Занято: {checked_out}/{pool_limit} ({checked_out / pool_limit:.0%}), свободно: {idle}, "
+            f"максимум занятых: {pool_stats.max_checked_out}\n"
+            f"Ожидание соединения: ср. {pool_stats.avg_wait * 1000:.1f}мс, макс. {pool_stats.max_wait * 1000:.1f}мс, "
+            f"таймаутов: {pool_stats.timeouts}\n\n"
+            f"<b>Очереди Telegram API</b> (в очереди / отправлено / ожидание ср. и макс.)\n")
+    for lane in Lane:
+        stats = rate_limiter.lanes.stats[lane]
+        text += (f"{lane.name.lower()}: {rate_limiter.lanes.depth(lane)} / {stats.granted} / "
+                 f"{stats.avg_wait:.2f}с, {stats.max_wait:.2f}с\n")
+    await message.answer(text)
+
+
 @admin_private_router.message(StateFilter("*"), F.text.casefold() == "отмена")
 async def cancel_fsm(message: Message, state: FSMContext) -> None:
     await state.clear()
@@ -90,7 +122,7 @@ async def get_message_for_mailing(message: Message, state: FSMContext):
     await state.set_state(Mailing.buttons)
     await message.reply("Будем добавлять URL-кнопки к сообщению?", reply_markup=await get_callback_btns(
         btns={"Добавить кнопки": "add_btns",
-              "Приступить к рассылке": "confirm_mailing",
+              "Приступить к рассылке": "mailing_audience",
               "Тестовая рассылка": "test_mailing",
               "Сделать другое сообщение для рассылки": "cancel_mailing"}, sizes=(1,)
     )
@@ -113,11 +145,21 @@ async def btns_to_data(message: Message, state: FSMContext):
         "message"],
                            reply_markup=await get_callback_btns(btns=data["buttons"]))
     await message.answer("Приступим к рассылке?",
-                         reply_markup=await get_callback_btns(btns={"Приступить к рассылке": "confirm_mailing",
+                         reply_markup=await get_callback_btns(btns={"Приступить к рассылке": "mailing_audience",
                                                                     "Тестовая рассылка": "test_mailing",
                                                                     "Переделать": "cancel_mailing"}))
 
 
+@admin_private_router.callback_query(StateFilter(Mailing.buttons), F.data == "mailing_audience")
+async def choose_mailing_audience(callback: CallbackQuery):
+    await callback.answer("")
+    await callback.message.answer("Кому отправить рассылку?", reply_markup=await get_callback_btns(
+        btns={"Всем пользователям": "confirm_mailing",
+              f"Активным за 7 дней (~{await get_active_users_count(7)})": "confirm_mailing_7",
+              f"Активным за 30 дней (~{await get_active_users_count(30)})": "confirm_mailing_30"}, sizes=(1,)
+    ))
+
+
 @admin_private_router.callback_query(StateFilter(Mailing.message), F.data == "cancel_mailing")
 @admin_private_router.callback_query(StateFilter(Mailing.buttons), F.data == "cancel_mailing")
 async def cancel_mailing(callback: CallbackQuery, state: FSMContext):
@@ -129,8 +171,9 @@ async def cancel_mailing(callback: CallbackQuery, state: FSMContext):
         await callback.message.answer("Отправь сообщение, которое ты хочешь рассылать")
 
 
-@admin_private_router.callback_query(StateFilter("*"), F.data.in_(["confirm_mailing", "test_mailing"]))
-async def confirm_mailing(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
+@admin_private_router.callback_query(StateFilter("*"),
+                                     F.data.startswith("confirm_mailing") | (F.data == "test_mailing"))
+async def confirm_mailing(callback: CallbackQuery, state: FSMContext):
     async with ChatActionSender.typing(bot=bot, chat_id=callback.message.from_user.id):
 
         if callback.data == "test_mailing":
@@ -143,25 +186,37 @@ async def confirm_mailing(callback: CallbackQuery, state: FSMContext, session: A
             await state.clear()
 
             success, notsuccess, blocked, elapsed_time_str = await simple_mailing_test(test_users, btns, msg_id, ch_id)
+            reclaimed = 0
 
         else:
             await callback.answer("")
-            await redis_set_mailing_users(await orm_get_mailing_list(session))
+            # confirm_mailing_{N} - только пользователям, активным за последние N дней
+            active_days = int(callback.data.split("_")[-1]) if callback.data != "confirm_mailing" else None
             data = await state.get_data()
-            await redis_set_mailing_msg(str(data.get("message")))
-            await redis_set_msg_from(str(callback.message.chat.id))
-            await redis_set_mailing_btns(data.get("buttons"))
             await state.clear()
 
-            success, notsuccess, blocked, elapsed_time_str = await simple_mailing()
-
-        if elapsed_time_str == "":
-            elapsed_time_str = "менее секунды"
+            # Получатели и сообщение записываются только под блокировкой рассылки,
+            # иначе две одновременные рассылки смешали бы аудитории и сообщения.
+            # Своя сессия: соединение возвращается в пул до начала отправки, а не через часы после неё
+            async def prepare():
+                async with unit_of_work() as session:
+                    async for users in orm_stream_mailing_list(session, chunk_size=mailing_chunk_size):
+                        if active_days:
+                            users = await redis_filter_active_users(users, active_days)
+                        if users:
+                            await redis_set_mailing_users(users)
+                await redis_set_mailing_msg(str(data.get("message")))
+                await redis_set_msg_from(str(callback.message.chat.id))
+                await redis_set_mailing_btns(data.get("buttons"))
+
+            result = await simple_mailing(prepare)
+            if result is None:
+                await callback.message.answer("Рассылка уже идёт, дождитесь её окончания.")
+                return
+            success, notsuccess, blocked, reclaimed, elapsed_time_str = result
 
         await callback.message.answer(
-            text=f"Рассылка успешна.\n\nРезультаты:\nУспешно - {success}\nНеудачно - {notsuccess}\n\n"
-                 f"Затрачено времени: <b>{elapsed_time_str}</b>\n\n"
-                 f"<span class='tg-spoiler'>Бот заблокирован у {blocked} пользователя(ей)</span>",
+            text=await mailing_report_text(success, notsuccess, blocked, elapsed_time_str, reclaimed),
             reply_markup=get_keyboard("Главное меню")
         )
 
@@ -309,9 +364,10 @@ async def get_top_finished_giveaways(message: Message, session: AsyncSession):
     messages = []
     limit = 4096
     places = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
+    creators = await get_users_creds([giv.user_id for giv in top_finished_giveaways])
     for i, giv in enumerate(top_finished_giveaways):
         giv_text = (f"{places[i]} /usergive{giv.id} <b>{giv.participants_count}</b>👥 | by: "
-                    f"{await get_user_creds(giv.user_id)}\n")
+                    f"{creators[i]}\n")
 
         if len(text) + len(giv_text) > limit:
             messages.append(text)
@@ -337,13 +393,10 @@ async def get_active_giveaways(message: Message, session: AsyncSession):
         return
 
     # Create a dictionary to store giveaways information
-    giveaways_info = []
-    for giv in active_giveaways:
-        participants_count = await redis_get_participants_count(giv)
-        giveaways_info.append({
-            "id": giv,
-            "participants_count": participants_count
-        })
+    giveaways_info = [
+        {"id": giv, "participants_count": participants_count}
+        for giv, participants_count in zip(active_giveaways, await redis_get_participants_counts(active_giveaways))
+    ]
 
     # Sort the list by participants count in descending order
     sorted_giveaways = sorted(giveaways_info, key=lambda x: x["participants_count"], reverse=True)
@@ -369,6 +422,11 @@ async def get_graph(message: Message, session: AsyncSession):
         await orm_get_user_regs_by_month(session=session, start_date=start_date, end_date=end_date))
     input_file = BufferedInputFile(graph_image.getvalue(), filename=f"graph.png")
     await message.answer_photo(photo=input_file)
+    monthly_active = await redis_get_monthly_active()
+    if monthly_active:
+        activity_image = await create_graph(monthly_active, title="Уникальные активные пользователи по месяцам",
+                                            ylabel="Количество активных пользователей", show_total=False)
+        await message.answer_photo(photo=BufferedInputFile(activity_image.getvalue(), filename="activity_graph.png"))
 
 
 @admin_private_router.callback_query(F.data.startswith("get_last_participants_"))
@@ -384,8 +442,8 @@ async def get_last_participants(callback: CallbackQuery):
         text = initial_text
         messages = []
         limit = 4096
-        for us_id in ids:
-            ans_text = f"{await get_user_creds(us_id)}\n"
+        for us_creds in await get_users_creds(ids):
+            ans_text = f"{us_creds}\n"
             if len(text) + len(ans_text) > limit:
                 messages.append(text)
                 text = initial_text + ans_text
@@ -4,7 +4,7 @@ from aiogram.types import ChatMemberUpdated
 from db.r_operations import redis_temp_channel
 from filters.chat_type import ChatType
 from tools.logs_channel import send_log
-from tools.utils import not_admin, get_user_creds, get_channel_hyperlink
+from tools.utils import not_admin, get_user_creds, get_channel_hyperlink, invalidate_chat_info
 
 channel_router = Router()
 channel_router.my_chat_member.filter(ChatType("channel"))
@@ -12,6 +12,7 @@ channel_router.my_chat_member.filter(ChatType("channel"))
 
 @channel_router.my_chat_member()
 async def on_chat_member_updated(update: ChatMemberUpdated):
+    invalidate_chat_info(update.chat.id)
     if update.new_chat_member.status == 'administrator':
         chat_id = update.chat.id
         user_id = update.from_user.id
@@ -11,9 +11,10 @@ from aiogram.types import Message, CallbackQuery
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from create_bot import bot
-from db.pg_orm_query import orm_get_channels_for_admin, orm_create_giveaway
+from db.pg_orm_query import orm_get_channels_for_admin
 from filters.chat_type import ChatType
 from keyboards.inline import get_callback_btns, captcha_toggle
+from tools.giveaway_changes import save_giveaway
 from tools.giveaway_utils import get_giveaway_preview, get_channel_hyperlink, \
     get_giveaway_info_text
 from tools.logs_channel import send_log
@@ -651,7 +652,7 @@ async def create_giveaway_captcha(callback, state, session):
         end_datetime = datetime.fromisoformat(end_datetime_str)
         data['end_datetime'] = end_datetime.replace(tzinfo=None).isoformat()
 
-    await orm_create_giveaway(session=session, data=data, user_id=user_id)
+    await save_giveaway(session=session, data=data, user_id=user_id)
     await state.clear()
     await callback.message.answer("✅ Розыгрыш сохранен и готовится к публикации!\n\n"
                                   "Для просмотра розыгрышей отправьте /my_gives\n\n"
@@ -10,21 +10,24 @@ from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import Message, BufferedInputFile, CallbackQuery
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from create_bot import bot
 from db.pg_models import GiveawayStatus
-from db.pg_orm_query import orm_get_join_giveaway_data, orm_get_user_giveaways, orm_get_giveaway_by_id, \
-    orm_get_giveaway_end_count, orm_delete_giveaway, orm_update_giveaway_end_conditions, orm_add_winners, \
-    orm_get_user_data, orm_user_start
+from db.pg_orm_query import orm_get_user_giveaways, orm_get_giveaway_by_id
 from db.r_engine import redis_conn
-from db.r_operations import redis_get_participants, redis_get_participants_count
+from db.r_operations import redis_get_participants, redis_get_participants_count, redis_is_participant, \
+    redis_join_giveaway, redis_set_giveaway_end_count, redis_get_notification_statuses, NOTIFICATION_SENT, \
+    NOTIFICATION_BLOCKED, NOTIFICATION_ERROR, NOTIFICATION_FAILED
 from filters.chat_type import ChatType
 from keyboards.inline import get_callback_btns
 from keyboards.reply import main_kb
 from tools.captcha import generate_captcha
-from tools.giveaway_scheduler import publish_giveaway_results
-from tools.giveaway_utils import add_participant_to_redis, check_giveaway_text
+from tools.giveaway_cache import get_giveaway_info
+from tools.giveaway_changes import remove_giveaway, update_giveaway_end_conditions, append_winners
+from tools.giveaway_scheduler import request_giveaway_results
+from tools.giveaway_utils import check_giveaway_text
+from tools.job_queue import enqueue_job
 from tools.texts import decode_giveaway_id, format_giveaways, datetime_example, encode_giveaway_id
-from tools.utils import is_subscribed, get_bot_link_to_start, is_admin
+from tools.utils import is_subscribed, get_bot_link_to_start, is_admin, get_users_creds, save_user
+from tools.winners_draw import draw_winners
 
 giveaway_interaction_router = Router()
 giveaway_interaction_router.message.filter(ChatType("private"))
@@ -49,13 +52,8 @@ class Captcha(StatesGroup):
 async def start_join_giveaway(message: Message, command: CommandObject, session: AsyncSession, state: FSMContext):
     encoded_id = command.args.split("_")[-1]
     giveaway_id = await decode_giveaway_id(encoded_id)
-    if await orm_get_user_data(session, user_id=message.from_user.id) is None:
-        await orm_user_start(session, data={
-            "user_id": message.from_user.id,
-            "username": message.from_user.username if message.from_user.username is not None else None,
-            "name": message.from_user.full_name,
-        })
-    giveaway = await orm_get_giveaway_by_id(session=session, giveaway_id=giveaway_id)
+    await save_user(session, message.from_user)
+    giveaway = await get_giveaway_info(session=session, giveaway_id=giveaway_id)
     if giveaway is None:
         await message.answer("Розыгрыш не найден.", reply_markup=await main_kb(await is_admin(message.from_user.id)))
         return
@@ -64,12 +62,12 @@ async def start_join_giveaway(message: Message, command: CommandObject, session:
             message.from_user.id)))
         return
     user_id = message.from_user.id
-    if user_id in await redis_get_participants(giveaway_id):
+    if await redis_is_participant(giveaway_id, user_id):
         await message.answer(f"❗️Вы уже участвуете в <a href='{giveaway.post_url}'>розыгрыше</a> №{giveaway_id}.",
                              reply_markup=await main_kb(await is_admin(message.from_user.id)))
         return
-    sponsor_channels, captcha, end_count = await orm_get_join_giveaway_data(session=session,
-                                                                            giveaway_id=giveaway_id)
+    # Всё нужное для вступления уже есть в кэшированных данных розыгрыша, база не нужна
+    sponsor_channels, captcha, end_count = giveaway.sponsor_channel_ids or [], giveaway.captcha, giveaway.end_count
 
     if await is_subscribed(channels=sponsor_channels, user_id=user_id) == False:
         await message.answer(
@@ -91,16 +89,19 @@ async def start_join_giveaway(message: Message, command: CommandObject, session:
                                                              "ответ!\n\n"
                                                              "<b>Для отказа от участия в розыгрыше нажмите</b> /cancel")
         await state.set_state(Captcha.awaiting_captcha)
-        await state.update_data(giveaway_id=giveaway_id, post_url=giveaway.post_url)
+        await state.update_data(giveaway_id=giveaway_id, post_url=giveaway.post_url, end_count=end_count)
     else:
-        await add_participant_to_redis(giveaway_id, user_id)
+        joined, _, end_reached = await redis_join_giveaway(giveaway_id, user_id, end_count)
         await state.clear()
+        if not joined:
+            await message.answer(f"❗️Вы уже участвуете в <a href='{giveaway.post_url}'>розыгрыше</a> №{giveaway_id}.",
+                                 reply_markup=await main_kb(await is_admin(message.from_user.id)))
+            return
         await message.answer(f"🎉 <b>Поздравляем!</b>\n"
                              f"Теперь Вы участник <a href='{giveaway.post_url}'>розыгрыша</a> №{giveaway_id}!",
                              reply_markup=await main_kb(await is_admin(message.from_user.id)))
-        if end_count:
-            if await redis_get_participants_count(giveaway_id) >= end_count:
-                await publish_giveaway_results(giveaway_id)
+        if end_reached:
+            request_giveaway_results(giveaway_id)
 
 
 @giveaway_interaction_router.message(
@@ -110,12 +111,7 @@ async def start_check_giveaway(message: Message, command: CommandObject, session
     encoded_id = command.args.split("_")[-1]
     giveaway_id = await decode_giveaway_id(encoded_id)
     giveaway = await orm_get_giveaway_by_id(session=session, giveaway_id=giveaway_id)
-    if await orm_get_user_data(session, user_id=message.from_user.id) is None:
-        await orm_user_start(session, data={
-            "user_id": message.from_user.id,
-            "username": message.from_user.username if message.from_user.username is not None else None,
-            "name": message.from_user.full_name,
-        })
+    await save_user(session, message.from_user)
     if giveaway is None:
         await message.answer("Розыгрыш не найден.",
                              reply_markup=await main_kb(await is_admin(message.from_user.id)))
@@ -146,16 +142,16 @@ async def check_captcha(message: Message, state: FSMContext, session: AsyncSessi
         data = await state.get_data()
         giveaway_id = data.get('giveaway_id')
         post_url = data.get('post_url')
-        await add_participant_to_redis(giveaway_id, user_id)
-        await message.answer(f"🎉 <b>Поздравляем!</b>\n"
-                             f"Теперь Вы участник <a href='{post_url}'>розыгрыша</a> №{giveaway_id}!")
+        joined, _, end_reached = await redis_join_giveaway(giveaway_id, user_id, data.get('end_count'))
+        if joined:
+            await message.answer(f"🎉 <b>Поздравляем!</b>\n"
+                                 f"Теперь Вы участник <a href='{post_url}'>розыгрыша</a> №{giveaway_id}!")
+        else:
+            await message.answer(f"❗️Вы уже участвуете в <a href='{post_url}'>розыгрыше</a> №{giveaway_id}.")
         await state.clear()
-        await add_participant_to_redis(giveaway_id, user_id)
         await redis_conn.delete(f"captcha:{user_id}")
-        end_count = await orm_get_giveaway_end_count(session, giveaway_id)
-        if end_count:
-            if await redis_get_participants_count(giveaway_id) >= end_count:
-                await publish_giveaway_results(giveaway_id)
+        if end_reached:
+            request_giveaway_results(giveaway_id)
     else:
         attempts_left -= 1
         if attempts_left > 0:
@@ -250,7 +246,7 @@ async def delete_giveaway(callback: CallbackQuery):
 async def delete_giveaway_sure(callback: CallbackQuery, session: AsyncSession):
     await callback.answer("")
     g_id = int(callback.data.split("_")[-1])
-    await orm_delete_giveaway(session=session, giveaway_id=g_id)
+    await remove_giveaway(session=session, giveaway_id=g_id)
     await callback.message.delete()
     await callback.message.answer("✅ Розыгрыш успешно удален.")
 
@@ -294,8 +290,9 @@ async def change_end_count_data(message: Message, state: FSMContext, session: As
     if int(message.text) > p_count:
         giveaway_id = data.get('giveaway_id')
         end_count = int(message.text)
-        await orm_update_giveaway_end_conditions(session=session, giveaway_id=giveaway_id, end_count=end_count,
-                                                 end_datetime=None)
+        await update_giveaway_end_conditions(session=session, giveaway_id=giveaway_id, end_count=end_count,
+                                              end_datetime=None)
+        await redis_set_giveaway_end_count(giveaway_id, end_count)
         await message.answer("🎉 Количество участников для проведения розыгрыша изменено!")
         await state.clear()
     else:
@@ -336,8 +333,9 @@ async def change_end_time_data(message: Message, state: FSMContext, session: Asy
             return
 
         end_time = user_datetime.replace(tzinfo=None).isoformat()
-        await orm_update_giveaway_end_conditions(session=session, giveaway_id=data.get('giveaway_id'), end_count=None,
-                                                 end_datetime=end_time)
+        await update_giveaway_end_conditions(session=session, giveaway_id=data.get('giveaway_id'), end_count=None,
+                                              end_datetime=end_time)
+        await redis_set_giveaway_end_count(data.get('giveaway_id'), None)
         await message.answer("✅Время для подведения результатов сохранено")
         await state.clear()
     except ValueError:
@@ -360,7 +358,7 @@ async def finish_giveaway_sure(callback: CallbackQuery):
     await callback.answer("")
     giveaway_id = int(callback.data.split("_")[-1])
     await callback.message.answer("Заканчиваем розыгрыш...")
-    await publish_giveaway_results(giveaway_id)
+    await enqueue_job("publish_giveaway_results", giveaway_id=giveaway_id)
 
 
 @giveaway_interaction_router.callback_query(F.data.startswith("get_result_link_"))
@@ -373,6 +371,36 @@ async def get_result_link(callback: CallbackQuery):
                                   f"<code>{await get_bot_link_to_start()}checkgive_{g_id}</code>")
 
 
+delivery_status_text = {
+    NOTIFICATION_BLOCKED: "бот заблокирован",
+    NOTIFICATION_ERROR: "не удалось отправить",
+    NOTIFICATION_FAILED: "ошибка Telegram, повторяем",
+}
+
+
+@giveaway_interaction_router.callback_query(F.data.startswith("winners_delivery_"))
+async def get_winners_delivery(callback: CallbackQuery, session: AsyncSession):
+    await callback.answer("")
+    giveaway_id = int(callback.data.split("_")[-1])
+    giveaway = await orm_get_giveaway_by_id(session=session, giveaway_id=giveaway_id)
+    if giveaway is None or (giveaway.user_id != callback.from_user.id and not await is_admin(callback.from_user.id)):
+        return
+    winners = giveaway.winner_ids or []
+    statuses = await redis_get_notification_statuses(giveaway_id)
+    sent = sum(1 for winner in winners if statuses.get(winner) == NOTIFICATION_SENT)
+    text = (f"Уведомления победителям розыгрыша #{giveaway_id}:\n\n"
+            f"✅ Доставлено: {sent} из {len(winners)}\n")
+    undelivered = [winner for winner in winners if statuses.get(winner) != NOTIFICATION_SENT]
+    if undelivered:
+        text += "\nНе доставлено:\n"
+        shown = undelivered[:50]
+        for winner, winner_creds in zip(shown, await get_users_creds(shown)):
+            text += f"❌ {winner_creds} - {delivery_status_text.get(statuses.get(winner), 'ожидает отправки')}\n"
+        if len(undelivered) > len(shown):
+            text += f"...и ещё {len(undelivered) - len(shown)}\n"
+    await callback.message.answer(text)
+
+
 class AddWinners(StatesGroup):
     giveaway_id = State()
 
@@ -408,12 +436,8 @@ async def add_winners_data(message: Message, state: FSMContext, session: AsyncSe
     # Перемешиваем список участников для случайного выбора
     shuffle(participants)
 
-    winners = []
-    for user_id in participants:
-        if (await is_subscribed(giveaway.sponsor_channel_ids, user_id)) and user_id not in giveaway.winner_ids:
-            winners.append(user_id)
-            if len(winners) == add_win_count:
-                break
+    winners = await draw_winners(participants, giveaway.sponsor_channel_ids, add_win_count,
+                                 exclude=giveaway.winner_ids)
 
     if not winners:
         await message.answer(reply_to_message_id=message.message_id,
@@ -422,13 +446,10 @@ async def add_winners_data(message: Message, state: FSMContext, session: AsyncSe
     if winners:
         text = ""
         c = 0
-        for winners_id in winners:
+        for winner_creds in await get_users_creds(winners):
             c += 1
-            chat = await bot.get_chat(winners_id)
-            user_name = chat.first_name if chat.first_name else "No name"
-            user_username = f"@{chat.username}" if chat.username else ""
-            text += f"\n{c}.<a href='tg://user?id={winners_id}'>{user_name}</a> ({user_username})"
+            text += f"\n{c}.{winner_creds}"
         await message.answer(reply_to_message_id=message.message_id,
                              text=f"Выбор дополнительных победителей завершен!\n{text}")
-        await orm_add_winners(session=session, giveaway_id=giveaway_id, new_winners=winners)
+        await append_winners(session=session, giveaway_id=giveaway_id, new_winners=winners)
     await state.clear()
@@ -4,7 +4,7 @@ from aiogram.types import ChatMemberUpdated
 from db.r_operations import redis_temp_channel
 from filters.chat_type import ChatType
 from tools.logs_channel import send_log
-from tools.utils import not_admin, get_user_creds, get_channel_hyperlink
+from tools.utils import not_admin, get_user_creds, get_channel_hyperlink, invalidate_chat_info
 
 group_router = Router()
 
@@ -13,6 +13,7 @@ group_router.my_chat_member.filter(ChatType(["supergroup", "group"]))
 
 @group_router.my_chat_member()
 async def on_chat_member_updated(update: ChatMemberUpdated):
+    invalidate_chat_info(update.chat.id)
     print(update.new_chat_member.status)
     if update.new_chat_member.status == 'administrator':
         chat_id = update.chat.id
@@ -9,21 +9,16 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from create_bot import bot
 from db.pg_orm_query import orm_get_required_channels, orm_delete_channel, orm_add_channel, \
-    orm_add_admin_to_channel
-from db.pg_orm_query import (
-    orm_user_start,
-    orm_get_user_data,
-    orm_get_channels_for_admin)
+    orm_add_admin_to_channel, orm_get_channels_for_admin
 from db.r_operations import redis_check_channel, redis_get_channel_id
 from filters.chat_type import ChatType
 from keyboards.inline import get_callback_btns
 from keyboards.reply import main_kb, get_keyboard
-from middlewares.activity_middleware import ActivityMiddleware
 from tools.texts import cbk_msg
-from tools.utils import msg_to_cbk, channel_info, convert_id, is_subscribed, get_channel_hyperlink, is_admin
+from tools.utils import msg_to_cbk, channel_info, convert_id, is_subscribed, get_channel_hyperlink, is_admin, \
+    save_user
 
 user_router = Router()
-user_router.message.middleware(ActivityMiddleware())
 user_router.message.filter(ChatType("private"))
 
 
@@ -53,17 +48,9 @@ async def cmd_start(message: Message, session: AsyncSession, state: FSMContext):
             "❗️Также в Нашем боте присутствует <b>капча</b> для защиты от накрутки ботов.\n"
             "И самое интересное, у нас есть функция создания постов с кнопкой!"
             )
-    if await orm_get_user_data(session, user_id=message.from_user.id) is not None:
-        await message.answer(text,
-                             reply_markup=await main_kb(await is_admin(message.from_user.id)))
-    else:
-        await orm_user_start(session, data={
-            "user_id": message.from_user.id,
-            "username": message.from_user.username if message.from_user.username is not None else None,
-            "name": message.from_user.full_name,
-        })
-        await message.answer(text,
-                             reply_markup=await main_kb(await is_admin(message.from_user.id)))
+    await save_user(session, message.from_user)
+    await message.answer(text,
+                         reply_markup=await main_kb(await is_admin(message.from_user.id)))
 
 
 @user_router.message(F.text == "Главное меню")
@@ -69,6 +69,7 @@ async def admin_kb():
         [KeyboardButton(text="Активные розыгрыши")],
         [KeyboardButton(text="Топ законченных розыгрышей")],
         [KeyboardButton(text="График по месяцам")],
+        [KeyboardButton(text="Статистика бота")],
         [KeyboardButton(text="Главное меню")]
     ]
     # if env_admin:
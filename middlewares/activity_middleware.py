@@ -1,21 +1,20 @@
-from datetime import datetime
-from datetime import timezone
 from typing import Dict, Callable, Any, Awaitable
 
 from aiogram import BaseMiddleware
-from aiogram.types import Message
+from aiogram.types import TelegramObject, User
 
-from db.r_engine import redis_conn
+from tools.activity_buffer import activity_buffer
 
 
 class ActivityMiddleware(BaseMiddleware):
     async def __call__(
             self,
-            handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
-            event: Message,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
             data: Dict[str, Any]
     ) -> Any:
-        user_id = event.from_user.id
-        timestamp = int(datetime.now(timezone.utc).timestamp())
-        await redis_conn.setex(f"user_activity:{user_id}", 2678400, timestamp)
+        user: User | None = data.get("event_from_user")
+        if user is not None and not user.is_bot:
+            # Запись в Redis делает фоновая задача, обработчик не ждёт
+            activity_buffer.touch(user.id)
         return await handler(event, data)
@@ -2,13 +2,12 @@ from typing import Callable, Awaitable, Dict, Any
 
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
-from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from db.pg_engine import unit_of_work
 
 
 class DbSessionMiddleware(BaseMiddleware):
-    def __init__(self, session_pool: async_sessionmaker):
-        super().__init__()
-        self.session_pool = session_pool
+    """Gives every update its own unit of work: committed after the handler, rolled back if it fails."""
 
     async def __call__(
             self,
@@ -16,6 +15,6 @@ class DbSessionMiddleware(BaseMiddleware):
             event: TelegramObject,
             data: Dict[str, Any],
     ) -> Any:
-        async with self.session_pool() as session:
+        async with unit_of_work() as session:
             data["session"] = session
-            return await handler(event, data)
\ No newline at end of file
+            return await handler(event, data)
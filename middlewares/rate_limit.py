@@ -0,0 +1,218 @@
+import asyncio
+import enum
+import functools
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from decouple import config
+
+from tools.cache import TTLCache
+
+logger = logging.getLogger("aiogram.rate_limit")
+
+global_rate = config("TG_GLOBAL_RATE", default=30, cast=float)
+private_chat_rate = config("TG_PRIVATE_CHAT_RATE", default=1, cast=float)
+group_chat_per_minute = config("TG_GROUP_CHAT_PER_MINUTE", default=20, cast=float)
+max_retries = config("TG_MAX_RETRIES", default=3, cast=int)
+
+# Методы, которые отправляют или меняют сообщения и попадают под лимиты Telegram
+limited_prefixes = ("send", "copy", "forward", "edit")
+not_limited_methods = {"sendChatAction"}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                delay = self._blocked_until - now
+                if delay <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+                await asyncio.sleep(delay)
+
+    def block(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class Lane(enum.IntEnum):
+    INTERACTIVE = 0
+    GIVEAWAY = 1
+    NOTIFICATIONS = 2
+    MAILING = 3
+    LOGS = 4
+
+
+# Доля глобального бюджета при конкуренции: ответы пользователям > публикация/итоги > уведомления > рассылка > логи
+lane_weights = {
+    Lane.INTERACTIVE: 16,
+    Lane.GIVEAWAY: 8,
+    Lane.NOTIFICATIONS: 4,
+    Lane.MAILING: 2,
+    Lane.LOGS: 1,
+}
+
+current_lane: ContextVar[Lane] = ContextVar("outbound_lane", default=Lane.INTERACTIVE)
+
+
+def outbound_lane(lane: Lane):
+    """Runs every Telegram request made inside the decorated coroutine in the given priority lane."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = current_lane.set(lane)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                current_lane.reset(token)
+
+        return wrapper
+
+    return decorator
+
+
+class LaneStats:
+    def __init__(self):
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def avg_wait(self) -> float:
+        return self.total_wait / self.granted if self.granted else 0.0
+
+
+class LaneScheduler:
+    """
+    Hands out global tokens to waiting requests with stride scheduling: every lane gets a share
+    proportional to its weight, so bulk lanes slow down under load but are never starved and never starve others.
+    """
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.stats = {lane: LaneStats() for lane in Lane}
+        self._queues: dict[Lane, deque[tuple[asyncio.Future, float]]] = {lane: deque() for lane in Lane}
+        self._pass = {lane: 0.0 for lane in Lane}
+        self._virtual_time = 0.0
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+
+    def depth(self, lane: Lane) -> int:
+        return len(self._queues[lane])
+
+    async def acquire(self, lane: Lane):
+        future = asyncio.get_running_loop().create_future()
+        if not self._queues[lane]:
+            # Простаивавшая полоса не копит «кредит» за время простоя
+            self._pass[lane] = max(self._pass[lane], self._virtual_time)
+        self._queues[lane].append((future, time.monotonic()))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        await future
+
+    def _next_waiter(self):
+        for queue in self._queues.values():
+            while queue and queue[0][0].done():
+                queue.popleft()
+        waiting = [lane for lane in Lane if self._queues[lane]]
+        if not waiting:
+            return None
+        lane = min(waiting, key=lambda item: (self._pass[item], item))
+        self._virtual_time = self._pass[lane]
+        self._pass[lane] += 1 / lane_weights[lane]
+        return lane, self._queues[lane].popleft()
+
+    async def _dispatch(self):
+        while True:
+            if not any(self._queues.values()):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self.bucket.acquire()
+            waiter = self._next_waiter()
+            if waiter is None:
+                continue
+            lane, (future, enqueued) = waiter
+            waited = time.monotonic() - enqueued
+            stats = self.stats[lane]
+            stats.granted += 1
+            stats.total_wait += waited
+            stats.max_wait = max(stats.max_wait, waited)
+            future.set_result(None)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Shares one Telegram budget between every code path using the bot: a global bucket (~30 msg/s)
+    split between priority lanes, a per-chat bucket (1 msg/s in private chats, 20 msg/min in groups
+    and channels) and automatic retries after TelegramRetryAfter.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self.lanes = LaneScheduler(self.global_bucket)
+        # Простаивающий чат через минуту снова имеет полный бюджет, поэтому его ведро можно забыть
+        self.chat_buckets = TTLCache(maxsize=50000, ttl=60)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(rate=private_chat_rate, capacity=3)
+            else:
+                bucket = TokenBucket(rate=group_chat_per_minute / 60, capacity=group_chat_per_minute)
+        self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        api_method = method.__api_method__
+        if not api_method.startswith(limited_prefixes) or api_method in not_limited_methods:
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+
+        attempt = 0
+        while True:
+            if chat_bucket is not None:
+                await chat_bucket.acquire()
+            await self.lanes.acquire(current_lane.get())
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > max_retries:
+                    raise
+                logger.warning(f"Flood control on {api_method} for chat {chat_id}, retry in {e.retry_after}s")
+                (chat_bucket or self.global_bucket).block(e.retry_after)
+
+
+rate_limiter = RateLimitMiddleware()
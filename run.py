@@ -4,15 +4,18 @@ from aiogram.types import BotCommand, BotCommandScopeDefault
 
 from create_bot import bot, dp, env_admins
 from db.pg_engine import create_db
-from db.pg_engine import session_maker
+from db.r_operations import redis_migrate_participants, redis_migrate_user_activity
 from handlers.admin_private import admin_private_router
 from handlers.channels import channel_router
 from handlers.giveaway_create_router import giveaway_create_router
 from handlers.giveaway_interaction_router import giveaway_interaction_router
 from handlers.groups import group_router
 from handlers.user_router import user_router
+from middlewares.activity_middleware import ActivityMiddleware
 from middlewares.db import DbSessionMiddleware
+from tools.activity_buffer import activity_buffer
 from tools.giveaway_scheduler import start_scheduler
+from tools.mailing import resume_mailing
 
 
 async def set_commands():
@@ -34,6 +37,7 @@ async def start_bot():
 
 
 async def stop_bot():
+    await activity_buffer.flush()
     try:
         for admin_id in env_admins:
             await bot.send_message(admin_id, "Бот остановлен.\n😴")
@@ -43,13 +47,16 @@ async def stop_bot():
 
 async def main():
     await create_db()
+    await redis_migrate_participants()
+    await redis_migrate_user_activity()
     dp.include_router(giveaway_interaction_router)
     dp.include_router(admin_private_router)
     dp.include_router(user_router)
     dp.include_router(channel_router)
     dp.include_router(group_router)
     dp.include_router(giveaway_create_router)
-    dp.update.middleware(DbSessionMiddleware(session_pool=session_maker))
+    dp.update.middleware(DbSessionMiddleware())
+    dp.update.middleware(ActivityMiddleware())
 
     dp.startup.register(start_bot)
     dp.shutdown.register(stop_bot)
@@ -58,6 +65,10 @@ async def main():
         await bot.delete_webhook(drop_pending_updates=False)
         # Start the scheduler in the background
         asyncio.create_task(start_scheduler())
+        # Write buffered user activity to Redis in batches
+        asyncio.create_task(activity_buffer.run())
+        # Continue a mailing interrupted by a restart
+        asyncio.create_task(resume_mailing())
         # Start polling
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import time
+
+from decouple import config
+
+from db.r_operations import redis_record_user_activity
+
+logger = logging.getLogger(__name__)
+
+activity_buffer_size = config("ACTIVITY_BUFFER_SIZE", default=50000, cast=int)
+activity_flush_size = config("ACTIVITY_FLUSH_SIZE", default=500, cast=int)
+activity_flush_interval = config("ACTIVITY_FLUSH_INTERVAL", default=0.3, cast=float)
+
+
+class ActivityBuffer:
+    """
+    Collects last-seen timestamps in memory and writes them to Redis in pipelined batches.
+    Repeated updates from one user are merged; when the buffer is full new users are dropped instead of waiting.
+    """
+
+    def __init__(self, maxsize: int, flush_size: int, flush_interval: float):
+        self.maxsize = maxsize
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.flushed = 0
+        self._pending: dict[int, int] = {}
+        self._full = asyncio.Event()
+
+    def touch(self, user_id: int):
+        if user_id not in self._pending and len(self._pending) >= self.maxsize:
+            self.dropped += 1
+            return
+        self._pending[user_id] = int(time.time())
+        if len(self._pending) >= self.flush_size:
+            self._full.set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        self._full.clear()
+        try:
+            await redis_record_user_activity(batch)
+            self.flushed += len(batch)
+        except Exception as e:
+            logger.warning(f"Failed to flush {len(batch)} activity entries: {e}")
+            # Возвращаем пачку в буфер, более свежие отметки не перезаписываем
+            for user_id, timestamp in batch.items():
+                if len(self._pending) >= self.maxsize:
+                    self.dropped += 1
+                    continue
+                self._pending.setdefault(user_id, timestamp)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+
+activity_buffer = ActivityBuffer(activity_buffer_size, activity_flush_size, activity_flush_interval)
@@ -0,0 +1,91 @@
+import asyncio
+import random
+import time
+
+from decouple import config
+
+from db.pg_engine import unit_of_work
+from db.pg_orm_query import orm_get_published_giveaways
+from db.r_operations import redis_get_participants_counts, redis_get_rendered_counts, redis_set_rendered_count, \
+    redis_delete_rendered_counts
+from tools.giveaway_utils import edit_giveaway_button
+from tools.logs_channel import send_log
+
+# Интервал проверки розыгрыша: сокращается вдвое, пока участники прибывают, и удваивается, пока их нет
+button_refresh_min_interval = config("BUTTON_REFRESH_MIN_INTERVAL", default=5, cast=float)
+button_refresh_max_interval = config("BUTTON_REFRESH_MAX_INTERVAL", default=300, cast=float)
+# Как часто перечитывать список опубликованных розыгрышей из базы
+button_refresh_reload_interval = 60
+
+
+class ButtonRefresher:
+    """Keeps the participant count on published giveaway buttons up to date, editing only posts whose count changed."""
+
+    def __init__(self):
+        # giveaway_id -> (channel_id, message_id, button)
+        self.posts: dict[int, tuple[int, int, str]] = {}
+        self.rendered: dict[int, int] = {}
+        self.intervals: dict[int, float] = {}
+        self.next_check: dict[int, float] = {}
+        self.edits = 0
+
+    async def reload(self):
+        async with unit_of_work() as session:
+            published = await orm_get_published_giveaways(session)
+        posts = {giveaway_id: (channel_id, message_id, button)
+                 for giveaway_id, channel_id, message_id, button in published}
+        finished = [giveaway_id for giveaway_id in self.posts if giveaway_id not in posts]
+        for giveaway_id in finished:
+            self.forget(giveaway_id)
+        await redis_delete_rendered_counts(finished)
+        new = [giveaway_id for giveaway_id in posts if giveaway_id not in self.posts]
+        # Показанные счётчики хранятся в Redis, чтобы после перезапуска или смены лидера не править все посты разом
+        self.rendered.update(await redis_get_rendered_counts(new))
+        now = time.monotonic()
+        for giveaway_id in new:
+            self.intervals[giveaway_id] = button_refresh_min_interval
+            self.next_check[giveaway_id] = now + random.uniform(0, button_refresh_min_interval)
+        self.posts = posts
+
+    def forget(self, giveaway_id: int):
+        self.posts.pop(giveaway_id, None)
+        self.rendered.pop(giveaway_id, None)
+        self.intervals.pop(giveaway_id, None)
+        self.next_check.pop(giveaway_id, None)
+
+    async def refresh_due(self):
+        now = time.monotonic()
+        due = [giveaway_id for giveaway_id, check_at in self.next_check.items() if check_at <= now]
+        if not due:
+            return
+        for giveaway_id, count in zip(due, await redis_get_participants_counts(due)):
+            interval = self.intervals[giveaway_id]
+            if count != self.rendered.get(giveaway_id):
+                channel_id, message_id, button = self.posts[giveaway_id]
+                self.edits += 1
+                if not await edit_giveaway_button(giveaway_id, channel_id, message_id, button, count):
+                    self.forget(giveaway_id)
+                    continue
+                self.rendered[giveaway_id] = count
+                await redis_set_rendered_count(giveaway_id, count)
+                interval = max(button_refresh_min_interval, interval / 2)
+            else:
+                interval = min(button_refresh_max_interval, interval * 2)
+            self.intervals[giveaway_id] = interval
+            # Случайный разброс, чтобы правки разных постов не шли пачками
+            self.next_check[giveaway_id] = time.monotonic() + interval * random.uniform(0.8, 1.2)
+
+    async def run(self):
+        reloaded = 0.0
+        while True:
+            try:
+                if time.monotonic() - reloaded >= button_refresh_reload_interval:
+                    await self.reload()
+                    reloaded = time.monotonic()
+                await self.refresh_due()
+            except Exception as e:
+                await send_log(text=f"Ошибка обновления кнопок розыгрышей:\n\n{e}")
+            await asyncio.sleep(1)
+
+
+button_refresher = ButtonRefresher()
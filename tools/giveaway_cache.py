@@ -0,0 +1,62 @@
+from functools import partial
+from typing import Optional
+
+from decouple import config
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.pg_engine import after_commit
+from db.pg_models import GiveawayStatus
+from db.pg_orm_query import GiveawayInfo, orm_get_giveaway_summary
+from db.r_operations import redis_get_giveaway_info, redis_get_giveaway_version, redis_store_giveaway_info, \
+    redis_invalidate_giveaway_info
+from tools.cache import TTLCache
+
+# Локальная копия живёт недолго: изменения из других реплик видны не позже чем через это время
+giveaway_local_ttl = config("GIVEAWAY_CACHE_LOCAL_TTL", default=5, cast=float)
+giveaway_redis_ttl = config("GIVEAWAY_CACHE_REDIS_TTL", default=3600, cast=int)
+giveaway_cache = TTLCache(maxsize=config("GIVEAWAY_CACHE_SIZE", default=5000, cast=int), ttl=giveaway_local_ttl)
+
+
+async def get_cached_giveaway(giveaway_id: int) -> Optional[GiveawayInfo]:
+    info = giveaway_cache.get(giveaway_id)
+    if info is not None:
+        return info
+    data = await redis_get_giveaway_info(giveaway_id)
+    if data is None:
+        return None
+    data["status"] = GiveawayStatus(data["status"])
+    info = GiveawayInfo(**data)
+    giveaway_cache.set(giveaway_id, info)
+    return info
+
+
+async def cache_giveaway(info: GiveawayInfo, version: str):
+    giveaway_cache.set(info.id, info)
+    data = info._asdict()
+    data["status"] = info.status.value
+    await redis_store_giveaway_info(info.id, data, version, giveaway_redis_ttl)
+
+
+async def invalidate_giveaway(giveaway_id: int):
+    giveaway_cache.pop(giveaway_id)
+    await redis_invalidate_giveaway_info(giveaway_id)
+
+
+# Сброс кэша после коммита: до него другие транзакции ещё видят старые данные
+def invalidate_giveaway_after_commit(session: AsyncSession, giveaway_id: int):
+    after_commit(session, partial(invalidate_giveaway, giveaway_id))
+
+
+# Облегчённые данные розыгрыша через кэш (локальный + Redis), в базу только при промахе
+async def get_giveaway_info(session: AsyncSession, giveaway_id: int) -> Optional[GiveawayInfo]:
+    info = await get_cached_giveaway(giveaway_id)
+    if info is not None:
+        return info
+    version = await redis_get_giveaway_version(giveaway_id)
+    info = await orm_get_giveaway_summary(session, giveaway_id)
+    if info is None:
+        return None
+    # Транзакция с незакоммиченными изменениями может видеть данные, которых не увидят другие
+    if not session.info.get("after_commit"):
+        await cache_giveaway(info, version)
+    return info
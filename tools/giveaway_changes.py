@@ -0,0 +1,69 @@
+from functools import partial
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.pg_engine import after_commit
+from db.pg_models import GiveawayStatus
+from db.pg_orm_query import orm_create_giveaway, orm_delete_giveaway, orm_update_giveaway_end_conditions, \
+    orm_update_giveaway_status, orm_update_giveaway_post_data, orm_add_winners, orm_delete_sponsor
+from tools.giveaway_cache import invalidate_giveaway_after_commit
+from tools.giveaway_timers import giveaway_timers, POST, END
+
+# Изменения розыгрышей вместе с их последствиями: таймеры планировщика и кэш переключаются после коммита
+
+
+async def save_giveaway(session: AsyncSession, data: dict, user_id: int):
+    giveaway = await orm_create_giveaway(session, data, user_id)
+    after_commit(session, partial(giveaway_timers.schedule, giveaway.id, POST, giveaway.post_datetime))
+
+
+async def remove_giveaway(session: AsyncSession, giveaway_id: int) -> bool:
+    if not await orm_delete_giveaway(session, giveaway_id):
+        return False
+    after_commit(session, partial(giveaway_timers.cancel, giveaway_id))
+    invalidate_giveaway_after_commit(session, giveaway_id)
+    return True
+
+
+async def update_giveaway_end_conditions(session: AsyncSession, giveaway_id: int,
+                                         end_datetime: Optional[str], end_count: Optional[int]) -> bool:
+    giveaway = await orm_update_giveaway_end_conditions(session, giveaway_id, end_datetime, end_count)
+    if giveaway is None:
+        return False
+    invalidate_giveaway_after_commit(session, giveaway_id)
+    # Неопубликованному розыгрышу таймер завершения ставится при публикации
+    if giveaway.end_datetime and giveaway.status == GiveawayStatus.PUBLISHED:
+        after_commit(session, partial(giveaway_timers.schedule, giveaway_id, END, giveaway.end_datetime))
+    elif not giveaway.end_datetime:
+        after_commit(session, partial(giveaway_timers.cancel, giveaway_id, END))
+    return True
+
+
+async def update_giveaway_status(session: AsyncSession, giveaway_id: int, status: GiveawayStatus,
+                                 participants_count: Optional[int] = None) -> bool:
+    if not await orm_update_giveaway_status(session, giveaway_id, status, participants_count):
+        return False
+    invalidate_giveaway_after_commit(session, giveaway_id)
+    if status == GiveawayStatus.FINISHED:
+        after_commit(session, partial(giveaway_timers.cancel, giveaway_id))
+    return True
+
+
+async def update_giveaway_post_data(session: AsyncSession, giveaway_id: int, post_url: str, message_id: int) -> bool:
+    if not await orm_update_giveaway_post_data(session, giveaway_id, post_url, message_id):
+        return False
+    invalidate_giveaway_after_commit(session, giveaway_id)
+    return True
+
+
+async def append_winners(session: AsyncSession, giveaway_id: int, new_winners: list[int]) -> bool:
+    if not await orm_add_winners(session, giveaway_id, new_winners):
+        return False
+    invalidate_giveaway_after_commit(session, giveaway_id)
+    return True
+
+
+async def delete_sponsor(session: AsyncSession, giveaway_id: int, sponsor_channel_id: int):
+    await orm_delete_sponsor(session, giveaway_id, sponsor_channel_id)
+    invalidate_giveaway_after_commit(session, giveaway_id)
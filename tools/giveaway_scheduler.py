@@ -1,150 +1,263 @@
 import asyncio
-import datetime
+import functools
+import json
 from random import shuffle
+from typing import Optional
 
-import pytz
 from aiogram.exceptions import TelegramBadRequest
+from decouple import config
 
 from create_bot import bot
-from db.pg_engine import session_maker
+from db.pg_engine import unit_of_work
 from db.pg_models import GiveawayStatus
-from db.pg_orm_query import orm_get_giveaway_by_id, orm_get_due_giveaways, \
-    orm_update_giveaway_status, orm_update_giveaway_post_data, orm_add_winners, orm_update_participants_count
-from db.r_operations import redis_create_giveaway, redis_get_participants, redis_expire_giveaway
+from db.pg_orm_query import orm_get_giveaway_by_id, orm_get_giveaway_summary, orm_get_pending_giveaways, \
+    orm_update_participants_count
+from db.r_engine import instance_id
+from db.r_operations import redis_create_giveaway, redis_get_participants, redis_expire_giveaway, \
+    redis_set_giveaway_end_count, redis_claim_lease, redis_get_lease_token, redis_acquire_lock, redis_release_lock, \
+    redis_extend_lock, redis_publish_timer_changes, redis_listen_timer_changes, redis_get_finalize_requests, \
+    redis_clear_finalize_request, redis_get_giveaway_progress, redis_set_giveaway_progress
 from keyboards.inline import get_callback_btns
+from middlewares.rate_limit import outbound_lane, Lane
+from tools.button_refresh import button_refresher
+from tools.giveaway_changes import update_giveaway_status, update_giveaway_post_data, append_winners
 from tools.giveaway_utils import post_giveaway, giveaway_post_notification, giveaway_result_notification, \
-    update_giveaway_message, winners_notification
+    update_giveaway_message
+from tools.giveaway_timers import giveaway_timers, POST, END, moscow_now
+from tools.job_queue import job_handler, enqueue_job, run_job_workers
 from tools.logs_channel import send_log
 from tools.texts import encode_giveaway_id
-from tools.utils import convert_id, is_subscribed, get_bot_link_to_start, get_user_creds
+from tools.utils import convert_id, get_bot_link_to_start, get_users_creds
+from tools.winners_draw import draw_winners
 
-session = session_maker()
+# Планировщик работает только в одной реплике - держателе аренды в Redis
+scheduler_lease_ttl = config("SCHEDULER_LEASE_TTL", default=15, cast=float)
+# Время жизни блокировки публикации или подведения итогов; пока они идут, блокировка продлевается
+finalize_lock_ttl = config("FINALIZE_LOCK_TTL", default=600, cast=float)
 
+# Токен текущего лидерства, None - реплика не лидер
+scheduler_token: Optional[int] = None
 
+
+async def keep_lock(key: str, ttl: float):
+    while True:
+        await asyncio.sleep(ttl / 3)
+        await redis_extend_lock(key, instance_id, ttl)
+
+
+def run_once(event: str):
+    """Lets only one call per giveaway and event run at a time across all replicas; concurrent calls are skipped."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(giveaway_id):
+            lock_key = f"lock:giveaway:{giveaway_id}:{event}"
+            if not await redis_acquire_lock(lock_key, instance_id, finalize_lock_ttl):
+                return
+            # Долгий выбор победителей не должен пережить блокировку: иначе итоги подведёт и вторая реплика
+            lock_task = asyncio.create_task(keep_lock(lock_key, finalize_lock_ttl))
+            try:
+                return await func(giveaway_id)
+            finally:
+                lock_task.cancel()
+                await redis_release_lock(lock_key, instance_id)
+
+        return wrapper
+
+    return decorator
+
+
+@job_handler("publish_giveaway")
+@run_once(POST)
+@outbound_lane(Lane.GIVEAWAY)
 async def publish_giveaway(giveaway_id):
-    giveaway = await orm_get_giveaway_by_id(session, giveaway_id)
-    if giveaway:
+    async with unit_of_work() as session:
+        giveaway = await orm_get_giveaway_by_id(session, giveaway_id)
+    if not giveaway or giveaway.status != GiveawayStatus.NOT_PUBLISHED:
+        return
+    # Отправленный пост запоминается до записи в базу: повтор задачи не опубликует розыгрыш второй раз
+    progress = await redis_get_giveaway_progress(giveaway_id, POST)
+    if "message_id" not in progress:
         message = await post_giveaway(giveaway)
+        if message is None:
+            return
+        progress = {"chat_id": message.chat.id, "message_id": message.message_id}
+        await redis_set_giveaway_progress(giveaway_id, POST, **progress)
 
-        # Формируем ссылку на отправленное сообщение
-        chat_id = message.chat.id
-        clear_chat_id = await convert_id(chat_id)
-        message_id = message.message_id
-        post_url = f"https://t.me/c/{clear_chat_id}/{message_id}"
+    # Формируем ссылку на отправленное сообщение
+    clear_chat_id = await convert_id(progress["chat_id"])
+    message_id = progress["message_id"]
+    post_url = f"https://t.me/c/{clear_chat_id}/{message_id}"
+    if not progress.get("creator_notified"):
         await giveaway_post_notification(giveaway, post_url)
-        await redis_create_giveaway(giveaway.id)
-        # Обновляем запись в базе данных
-        await orm_update_giveaway_status(session, giveaway_id, GiveawayStatus.PUBLISHED)
-        await orm_update_giveaway_post_data(session, giveaway_id, post_url, message_id)
+        await redis_set_giveaway_progress(giveaway_id, POST, creator_notified=True)
+    await redis_create_giveaway(giveaway.id)
+    await redis_set_giveaway_end_count(giveaway.id, giveaway.end_count)
+    # Обновляем запись в базе данных
+    async with unit_of_work() as session:
+        await update_giveaway_status(session, giveaway_id, GiveawayStatus.PUBLISHED)
+        await update_giveaway_post_data(session, giveaway_id, post_url, message_id)
+    if giveaway.end_datetime:
+        giveaway_timers.schedule(giveaway.id, END, giveaway.end_datetime)
 
 
+@job_handler("publish_giveaway_results")
+@run_once(END)
+@outbound_lane(Lane.GIVEAWAY)
 async def publish_giveaway_results(giveaway_id):
-    giveaway = await orm_get_giveaway_by_id(session, giveaway_id)
-    msg_id = giveaway.message_id
-    await update_giveaway_message(session, giveaway.id, giveaway.channel_id, giveaway.message_id)
-    await asyncio.sleep(1 / 20)
-    verify_link = None
-    result_check = None
-    if giveaway and giveaway.status != GiveawayStatus.FINISHED:
-        # Получаем всех участников
-        participants = await redis_get_participants(giveaway_id)
-        if not participants:
-            message = await bot.send_message(reply_to_message_id=msg_id, chat_id=giveaway.channel_id,
-                                             text="Розыгрыш завершен, но участников нет.")
-            await giveaway_result_notification(message, giveaway)
-
-            await orm_update_giveaway_status(session, giveaway.id, GiveawayStatus.FINISHED)
-            return
+    # Соединение с базой не держим, пока идут запросы к Telegram: чтение и запись - отдельные транзакции
+    # Статус читаем из базы, а не из кэша: итоги не должны подводиться дважды
+    async with unit_of_work() as session:
+        giveaway = await orm_get_giveaway_summary(session, giveaway_id)
+    if giveaway is None or giveaway.status == GiveawayStatus.FINISHED:
+        await redis_clear_finalize_request(giveaway_id)
+        return
+    async with unit_of_work() as session:
+        await update_giveaway_message(session, giveaway.id, giveaway.channel_id, giveaway.message_id)
 
+    # Победители и отправленные сообщения запоминаются в Redis до перехода к следующему шагу, а розыгрыш
+    # завершается в базе последним: повтор задачи после сбоя не перевыбирает победителей и не шлёт итоги дважды
+    progress = await redis_get_giveaway_progress(giveaway_id, END)
+    participants = await redis_get_participants(giveaway_id)
+    if "winners" not in progress:
         # Перемешиваем список участников для случайного выбора
         shuffle(participants)
+        winners = await draw_winners(participants, giveaway.sponsor_channel_ids, giveaway.winners_count)
+        progress["winners"] = winners
+        await redis_set_giveaway_progress(giveaway_id, END, winners=winners)
+    winners = progress["winners"]
 
-        winners = []
-        for user_id in participants:
-            if await is_subscribed(giveaway.sponsor_channel_ids, user_id):
-                winners.append(user_id)
-                if len(winners) == giveaway.winners_count:
-                    break
+    verify_link = None
+    result_check = None
+    g_id = await encode_giveaway_id(giveaway.id)
+    if len(winners) < 100:
+        verify_link = f"<a href='{await get_bot_link_to_start()}checkgive_{g_id}'>Проверить результаты</a>"
+    else:
+        result_check = await get_callback_btns(
+            btns={"Проверить результаты": f"{await get_bot_link_to_start()}checkgive_{g_id}"})
 
+    if "message_id" not in progress:
         # Сообщение о завершении розыгрыша
-        if winners:
-            winner_mentions = []
-            c = 0
-            for winner in winners:
-                c += 1
-                winner_mentions.append(f"{c}.{await get_user_creds(winner)}")
-
-                # chat = await bot.get_chat(winner)
-                # user_name = chat.first_name if chat.first_name else "No name"
-                # user_username = f"@{chat.username}" if chat.username else f"{winner}"
-                # winner_mentions.append(f"{c}.<a href='tg://user?id={winner}'>{user_name}</a> ({user_username})")
-
+        if not participants:
+            giveaway_end_text = "Розыгрыш завершен, но участников нет."
+        elif winners:
+            winner_mentions = [f"{c}.{winner_creds}"
+                               for c, winner_creds in enumerate(await get_users_creds(winners), start=1)]
             giveaway_end_text = f"Розыгрыш завершен!\n\nПобедители:\n{'\n'.join(winner_mentions)}\n\n"
         else:
             giveaway_end_text = "Розыгрыш завершен, но подходящих победителей нет.\n\n"
-
-        g_id = await encode_giveaway_id(giveaway.id)
-        if len(winners) < 100:
-            verify_link = f"<a href='{await get_bot_link_to_start()}checkgive_{g_id}'>Проверить результаты</a>"
+        if participants and verify_link:
             giveaway_end_text += verify_link
-        else:
-            result_check = await get_callback_btns(
-                btns={"Проверить результаты": f"{await get_bot_link_to_start()}checkgive_{g_id}"})
 
-        await orm_update_giveaway_status(session, giveaway.id, GiveawayStatus.FINISHED)
-        await orm_update_participants_count(session, giveaway.id, len(participants))
         try:
-            if len(winners) < 100:
-                message = await bot.send_message(reply_to_message_id=msg_id, chat_id=giveaway.channel_id,
-                                                 text=giveaway_end_text)
-                await winners_notification(winners=winners, message=message, link=verify_link)
-            else:
-                message = await bot.send_message(reply_to_message_id=msg_id, chat_id=giveaway.channel_id,
-                                                 text=giveaway_end_text, reply_markup=result_check)
-                await winners_notification(winners=winners, message=message, link=verify_link)
-
+            message = await bot.send_message(reply_to_message_id=giveaway.message_id, chat_id=giveaway.channel_id,
+                                             text=giveaway_end_text, reply_markup=result_check)
+            progress.update(chat_id=message.chat.id, message_id=message.message_id)
         except TelegramBadRequest as e:
+            # Канал недоступен окончательно: розыгрыш всё равно завершается, но без поста с итогами
             await send_log(text=f"Розыгрыш #{giveaway.id}\n\n{e}")
-            # message = await bot.send_message(chat_id=giveaway.channel_id,
-            #                                  text=giveaway_end_text)
+            progress.update(chat_id=None, message_id=None)
+        await redis_set_giveaway_progress(giveaway_id, END, chat_id=progress["chat_id"],
+                                          message_id=progress["message_id"])
+
+    if progress["message_id"] is not None:
+        if winners and not progress.get("winners_notified"):
+            await enqueue_job("winners_notification", giveaway_id=giveaway.id, winners=winners,
+                              chat_id=progress["chat_id"], message_id=progress["message_id"], link=verify_link)
+            await redis_set_giveaway_progress(giveaway_id, END, winners_notified=True)
+        if not progress.get("creator_notified"):
+            await giveaway_result_notification(progress["chat_id"], progress["message_id"], giveaway)
+            await redis_set_giveaway_progress(giveaway_id, END, creator_notified=True)
+
+    async with unit_of_work() as session:
+        await update_giveaway_status(session, giveaway.id, GiveawayStatus.FINISHED)
+        await orm_update_participants_count(session, giveaway.id, len(participants))
         if winners:
-            await orm_add_winners(session, giveaway.id, winners)
-        await redis_expire_giveaway(giveaway.id)
-        await giveaway_result_notification(message, giveaway)
+            await append_winners(session, giveaway.id, winners)
+    await redis_expire_giveaway(giveaway.id)
+    await redis_clear_finalize_request(giveaway_id)
 
 
-async def schedule_giveaways():
-    while True:
-        current_time = datetime.datetime.now(pytz.timezone('Europe/Moscow')).replace(tzinfo=None)
+# Итоги подводит планировщик лидера, вызывающий обработчик не ждёт их
+def request_giveaway_results(giveaway_id: int):
+    giveaway_timers.schedule(giveaway_id, END, moscow_now())
 
-        not_published, ready_for_results = await orm_get_due_giveaways(session, current_time)
 
-        if not not_published and not ready_for_results:
-            continue
+async def load_giveaway_timers():
+    async with unit_of_work() as session:
+        pending = await orm_get_pending_giveaways(session)
+    giveaway_timers.clear()
+    for giveaway_id, status, post_datetime, end_datetime in pending:
+        if status == GiveawayStatus.NOT_PUBLISHED:
+            giveaway_timers.schedule(giveaway_id, POST, post_datetime, broadcast=False)
         else:
-            for giveaway in not_published:
-                giveaway_post_datetime = giveaway.post_datetime.replace(tzinfo=None) if giveaway.post_datetime else None
-                if giveaway_post_datetime <= current_time:
-                    await publish_giveaway(giveaway.id)
-                    await asyncio.sleep(1 / 20)
-
-            for giveaway in ready_for_results:
-                await update_giveaway_message(session, giveaway.id, giveaway.channel_id, giveaway.message_id)
-                await asyncio.sleep(1 / 20)
-                giveaway_end_datetime = giveaway.end_datetime.replace(tzinfo=None) if giveaway.end_datetime else None
-                if giveaway_end_datetime and giveaway_end_datetime <= current_time:
-                    await publish_giveaway_results(giveaway.id)
-                    await asyncio.sleep(1 / 20)
-                    continue
-
-                # if giveaway.end_count is not None:
-                #     participants_count = await redis_get_participants_count(giveaway.id)
-                #     if participants_count >= giveaway.end_count:
-                #         await publish_giveaway_results(giveaway.id)
-                #         await asyncio.sleep(1 / 20)
-
-        await asyncio.sleep(60)
+            giveaway_timers.schedule(giveaway_id, END, end_datetime, broadcast=False)
+    for giveaway_id in await redis_get_finalize_requests():
+        giveaway_timers.schedule(giveaway_id, END, moscow_now(), broadcast=False)
+
+
+async def schedule_giveaways(token: int):
+    await load_giveaway_timers()
+    while True:
+        for giveaway_id, event in await giveaway_timers.wait_due():
+            # Аренда могла истечь, пока мы ждали: бывший лидер больше не ставит задачи. Это не защищает от задач,
+            # поставленных им раньше, - повторы отсекают run_once и проверка статуса розыгрыша в обработчиках
+            if await redis_get_lease_token("scheduler", instance_id) != token:
+                return
+            try:
+                if event == POST:
+                    await enqueue_job("publish_giveaway", giveaway_id=giveaway_id)
+                else:
+                    await enqueue_job("publish_giveaway_results", giveaway_id=giveaway_id)
+            except Exception as e:
+                await send_log(text=f"Ошибка планировщика ({event}) для розыгрыша:\n/usergive{giveaway_id}\n\n{e}")
+
+
+# Пересылка изменений таймеров между репликами: лидер применяет изменения, сделанные в других репликах
+async def sync_giveaway_timers():
+    async def publish_changes():
+        while True:
+            changes = await giveaway_timers.wait_changes()
+            try:
+                await redis_publish_timer_changes(json.dumps({"from": instance_id, "changes": changes}))
+            except Exception as e:
+                await send_log(text=f"Не удалось разослать изменения таймеров розыгрышей:\n\n{e}")
+
+    async def listen_changes():
+        while True:
+            try:
+                async for data in redis_listen_timer_changes():
+                    message = json.loads(data)
+                    if message["from"] != instance_id and scheduler_token is not None:
+                        giveaway_timers.apply(message["changes"])
+            except Exception:
+                await asyncio.sleep(1)
+
+    await asyncio.gather(publish_changes(), listen_changes())
+
+
+# Выборы лидера: аренда продлевается каждые треть TTL, при смене токена задачи планировщика перезапускаются
+async def lead_scheduler():
+    global scheduler_token
+    tasks = []
+    while True:
+        try:
+            token = await redis_claim_lease("scheduler", instance_id, scheduler_lease_ttl)
+        except Exception:
+            token = None
+        if token != scheduler_token:
+            for task in tasks:
+                task.cancel()
+            tasks = []
+            scheduler_token = token
+            giveaway_timers.active = token is not None
+            if token is None:
+                giveaway_timers.clear()
+            else:
+                tasks = [asyncio.create_task(schedule_giveaways(token)),
+                         asyncio.create_task(button_refresher.run())]
+        await asyncio.sleep(scheduler_lease_ttl / 3)
 
 
 async def start_scheduler():
-    await schedule_giveaways()
+    await asyncio.gather(lead_scheduler(), sync_giveaway_timers(), run_job_workers())
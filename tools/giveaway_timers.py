@@ -0,0 +1,108 @@
+import asyncio
+import datetime
+import heapq
+
+import pytz
+
+POST = "post"
+END = "end"
+
+
+def moscow_now() -> datetime.datetime:
+    return datetime.datetime.now(pytz.timezone('Europe/Moscow')).replace(tzinfo=None)
+
+
+class GiveawayTimers:
+    """
+    Min-heap of upcoming giveaway deadlines (publication and results).
+    Rescheduled or cancelled entries stay in the heap and are skipped when they reach the top.
+    Only the scheduler leader keeps the heap; other replicas just broadcast their changes to it.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[datetime.datetime, int, str]] = []
+        self._deadlines: dict[tuple[int, str], datetime.datetime] = {}
+        self._changed = asyncio.Event()
+        # Локальные изменения, которые нужно разослать остальным репликам
+        self._outbox: list[tuple[int, str, str | None]] = []
+        self._outbox_ready = asyncio.Event()
+        # Реплика - лидер планировщика и сама ведёт кучу
+        self.active = False
+
+    def schedule(self, giveaway_id: int, event: str, when: datetime.datetime, broadcast: bool = True):
+        when = when.replace(tzinfo=None)
+        if self.active:
+            self._deadlines[(giveaway_id, event)] = when
+            heapq.heappush(self._heap, (when, giveaway_id, event))
+            self._changed.set()
+        if broadcast:
+            self._broadcast(giveaway_id, event, when.isoformat())
+
+    def cancel(self, giveaway_id: int, event: str = None, broadcast: bool = True):
+        for ev in (event,) if event else (POST, END):
+            if self.active:
+                self._deadlines.pop((giveaway_id, ev), None)
+            if broadcast:
+                self._broadcast(giveaway_id, ev, None)
+        self._changed.set()
+
+    def _broadcast(self, giveaway_id: int, event: str, when: str | None):
+        self._outbox.append((giveaway_id, event, when))
+        self._outbox_ready.set()
+
+    async def wait_changes(self) -> list[tuple[int, str, str | None]]:
+        await self._outbox_ready.wait()
+        self._outbox_ready.clear()
+        changes, self._outbox = self._outbox, []
+        return changes
+
+    def apply(self, changes: list[tuple[int, str, str | None]]):
+        """Applies changes made on another replica without broadcasting them again."""
+        for giveaway_id, event, when in changes:
+            if when is None:
+                self.cancel(giveaway_id, event, broadcast=False)
+            else:
+                self.schedule(giveaway_id, event, datetime.datetime.fromisoformat(when), broadcast=False)
+
+    def clear(self):
+        self._heap.clear()
+        self._deadlines.clear()
+        self._changed.set()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _drop_stale(self):
+        while self._heap:
+            when, giveaway_id, event = self._heap[0]
+            if self._deadlines.get((giveaway_id, event)) == when:
+                return
+            heapq.heappop(self._heap)
+
+    async def wait_due(self) -> list[tuple[int, str]]:
+        """Sleeps until the nearest deadline (or until the heap changes) and returns all due events."""
+        while True:
+            self._changed.clear()
+            self._drop_stale()
+            delay = None
+            if self._heap:
+                delay = (self._heap[0][0] - moscow_now()).total_seconds()
+                if delay <= 0:
+                    return self._pop_due()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _pop_due(self) -> list[tuple[int, str]]:
+        now = moscow_now()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, giveaway_id, event = heapq.heappop(self._heap)
+            if self._deadlines.get((giveaway_id, event)) == when:
+                del self._deadlines[(giveaway_id, event)]
+                due.append((giveaway_id, event))
+        return due
+
+
+giveaway_timers = GiveawayTimers()
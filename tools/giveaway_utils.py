@@ -3,18 +3,29 @@ import datetime
 from typing import Any
 
 import aiogram.exceptions
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, \
+    TelegramRetryAfter, TelegramServerError
+from decouple import config
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from create_bot import bot
+from db.pg_engine import unit_of_work
 from db.pg_models import GiveawayStatus
-from db.pg_orm_query import orm_get_giveaway_by_id, orm_delete_giveaway, orm_get_user_id_by_giveaway_id
-from db.r_operations import redis_get_participants_count, redis_add_participant
+from db.pg_orm_query import orm_get_giveaway_by_id, orm_get_user_id_by_giveaway_id
+from db.r_operations import redis_get_participants_count, redis_get_notification_statuses, \
+    redis_set_notification_status, NOTIFICATION_SENT, NOTIFICATION_BLOCKED, NOTIFICATION_ERROR, NOTIFICATION_FAILED
 from keyboards.inline import get_callback_btns
+from middlewares.rate_limit import outbound_lane, Lane
+from tools.giveaway_cache import get_giveaway_info
+from tools.giveaway_changes import remove_giveaway
+from tools.job_queue import job_handler
 from tools.texts import encode_giveaway_id, channel_conditions_text
 from tools.utils import channel_info, get_bot_link_to_start, convert_id, get_channel_hyperlink, post_deleted, \
-    send_log, get_user_creds, session
+    send_log, get_user_creds, channels_info, get_users_creds
+
+notification_concurrency = config("NOTIFICATION_CONCURRENCY", default=20, cast=int)
+notification_retries = config("NOTIFICATION_RETRIES", default=3, cast=int)
 
 
 async def get_giveaway_info_text(data: dict) -> str:
@@ -35,13 +46,7 @@ async def get_giveaway_info_text(data: dict) -> str:
 async def get_giveaway_preview(data: dict, user_id: int = None, bot=None):
     text = data["text"]
     text += "\n\n<b>Условия участия:</b>\n\n"
-    if "sponsor_channels" not in data or data["channel_id"] not in data["sponsor_channels"]:
-        channel = await channel_info(channel_id=data["channel_id"])
-        text += await channel_conditions_text(channel)
-    if "sponsor_channels" in data:
-        for channel in data["sponsor_channels"]:
-            channel = await channel_info(channel_id=channel)
-            text += await channel_conditions_text(channel)
+    text += await conditions_channels_text(data["channel_id"], data.get("sponsor_channels"))
     if "extra_conditions" in data:
         text += f'{data["extra_conditions"]}\n\n'
     if "end_datetime" in data:
@@ -72,6 +77,17 @@ async def get_giveaway_preview(data: dict, user_id: int = None, bot=None):
             return False
 
 
+# Условия подписки: канал розыгрыша (если его нет среди спонсоров) и каналы-спонсоры
+async def conditions_channels_text(channel_id: int, sponsor_channel_ids: list[int] | None) -> str:
+    channel_ids = list(sponsor_channel_ids or [])
+    if channel_id not in channel_ids:
+        channel_ids.insert(0, channel_id)
+    text = ""
+    for channel in await channels_info(channel_ids):
+        text += await channel_conditions_text(channel)
+    return text
+
+
 async def join_giveaway_link(giveaway_id: int) -> str:
     link = await get_bot_link_to_start()
     encoded = await encode_giveaway_id(giveaway_id)
@@ -83,8 +99,9 @@ async def not_posted_giveaway(giveaway_id, error_text):
     text = (f"Розыгрыш №{giveaway_id} не опубликован!\n"
             f"Причина: {error_text}\n\n"
             f"Розыгрыш был удалён из базы данных!")
-    user_id = await orm_get_user_id_by_giveaway_id(session=session, giveaway_id=giveaway_id)
-    await orm_delete_giveaway(session=session, giveaway_id=giveaway_id)
+    async with unit_of_work() as session:
+        user_id = await orm_get_user_id_by_giveaway_id(session=session, giveaway_id=giveaway_id)
+        await remove_giveaway(session=session, giveaway_id=giveaway_id)
     try:
         await bot.send_message(chat_id=user_id, text=text)
     except TelegramForbiddenError:
@@ -92,6 +109,7 @@ async def not_posted_giveaway(giveaway_id, error_text):
     await send_log(text=text + f"\n\n{await get_user_creds(user_id)}")
 
 
+@outbound_lane(Lane.GIVEAWAY)
 async def post_giveaway(giveaway):
     try:
         text = giveaway.text
@@ -99,14 +117,7 @@ async def post_giveaway(giveaway):
         text += "\n\n<b>Условия участия:</b>\n\n"
         message = None
 
-        if not giveaway.sponsor_channel_ids or giveaway.channel_id not in giveaway.sponsor_channel_ids:
-            channel = await channel_info(channel_id=giveaway.channel_id)
-            text += await channel_conditions_text(channel)
-
-        if giveaway.sponsor_channel_ids:
-            for channel_id in giveaway.sponsor_channel_ids:
-                channel = await channel_info(channel_id=channel_id)
-                text += await channel_conditions_text(channel)
+        text += await conditions_channels_text(giveaway.channel_id, giveaway.sponsor_channel_ids)
 
         if giveaway.extra_conditions:
             text += f"\n{giveaway.extra_conditions}\n\n"
@@ -135,6 +146,7 @@ async def post_giveaway(giveaway):
         await not_posted_giveaway(giveaway_id=giveaway.id, error_text=f"{e}")
 
 
+@outbound_lane(Lane.NOTIFICATIONS)
 async def giveaway_post_notification(giveaway, post_url):
     text = (
         f"Розыгрыш #{giveaway.id} опубликован!\n"
@@ -143,89 +155,122 @@ async def giveaway_post_notification(giveaway, post_url):
     await bot.send_message(chat_id=giveaway.user_id, text=text)
 
 
-async def winners_notification(winners: list, message, link=None, check_results=None):
-    try:
-        chat_id = message.chat.id
-        clear_chat_id = await convert_id(chat_id)
-        message_id = message.message_id
-        post_url = f"https://t.me/c/{clear_chat_id}/{message_id}"
-        winners_list = ""
-        for i, winner_id in enumerate(winners, start=1):
-            winners_list += f"{i}. {await get_user_creds(winner_id)}\n"
-
-        max_length = 4096
-        text = (f"🎉<b>Поздравляем!</b>\n\n"
-                f"Вы стали победителем <a href='{post_url}'>розыгрыша</a>!🎁\n\n"
-                f"<b>Благодарим за участие!</b>\n\n"
-                f"Список победителей:\n")
-
-        if len(winners) < 100:
-            text += f"{winners_list}\n{link}"
-        else:
-            text += f"{winners_list}\n"
-
-        text_parts = [text[i:i+max_length] for i in range(0, len(text), max_length)]
-
-        for winner in winners:
-            await asyncio.sleep(1 / 20)
-            for part in text_parts:
-                if len(winners) < 100:
-                    await bot.send_message(chat_id=winner, text=part)
-                else:
-                    await bot.send_message(chat_id=winner, text=part, reply_markup=check_results)
-    except aiogram.exceptions.TelegramForbiddenError:
-        # Можно добавить изменение статуса рассылки для юзера который заблокировал
-        pass
-
-
-async def giveaway_result_notification(message, giveaway):
-    chat_id = message.chat.id
+@job_handler("winners_notification")
+@outbound_lane(Lane.NOTIFICATIONS)
+async def winners_notification(giveaway_id: int, winners: list, chat_id: int, message_id: int, link=None):
+    """
+    Sends the winners message to every winner concurrently and stores each delivery status.
+    Only winners without a final status are sent to, so a retried job resends just the transient failures.
+    """
+    clear_chat_id = await convert_id(chat_id)
+    post_url = f"https://t.me/c/{clear_chat_id}/{message_id}"
+    winners_list = ""
+    for i, winner_creds in enumerate(await get_users_creds(winners), start=1):
+        winners_list += f"{i}. {winner_creds}\n"
+
+    max_length = 4096
+    text = (f"🎉<b>Поздравляем!</b>\n\n"
+            f"Вы стали победителем <a href='{post_url}'>розыгрыша</a>!🎁\n\n"
+            f"<b>Благодарим за участие!</b>\n\n"
+            f"Список победителей:\n")
+
+    if len(winners) < 100:
+        text += f"{winners_list}\n{link}"
+    else:
+        text += f"{winners_list}\n"
+
+    text_parts = [text[i:i+max_length] for i in range(0, len(text), max_length)]
+
+    statuses = await redis_get_notification_statuses(giveaway_id)
+    recipients = [winner for winner in winners if statuses.get(winner) in (None, NOTIFICATION_FAILED)]
+    semaphore = asyncio.Semaphore(notification_concurrency)
+
+    async def notify(winner: int):
+        async with semaphore:
+            for attempt in range(notification_retries + 1):
+                try:
+                    for part in text_parts:
+                        await bot.send_message(chat_id=winner, text=part)
+                    status = NOTIFICATION_SENT
+                except TelegramForbiddenError:
+                    status = NOTIFICATION_BLOCKED
+                except TelegramBadRequest:
+                    status = NOTIFICATION_ERROR
+                except (TelegramNetworkError, TelegramServerError, TelegramRetryAfter):
+                    # Временная ошибка Telegram: повторяем с растущей паузой
+                    status = NOTIFICATION_FAILED
+                    if attempt < notification_retries:
+                        await asyncio.sleep(2 ** attempt)
+                        continue
+                except TelegramAPIError:
+                    # Неизвестная ошибка: повторим вместе с задачей
+                    status = NOTIFICATION_FAILED
+                break
+        await redis_set_notification_status(giveaway_id, winner, status)
+        return status
+
+    # Задача падает только после того, как у каждого получателя записан статус
+    results = await asyncio.gather(*(notify(winner) for winner in recipients), return_exceptions=True)
+    failed = sum(1 for result in results if result == NOTIFICATION_FAILED or isinstance(result, Exception))
+    if failed:
+        # Задача будет повторена очередью, уже уведомлённые победители пропускаются
+        raise RuntimeError(f"{failed} winners of giveaway #{giveaway_id} were not notified")
+
+
+@outbound_lane(Lane.NOTIFICATIONS)
+async def giveaway_result_notification(chat_id: int, message_id: int, giveaway):
     clear_chat_id = await convert_id(chat_id)
-    message_id = message.message_id
     post_url = f"https://t.me/c/{clear_chat_id}/{message_id}"
     text = (
         f"Розыгрыш #{giveaway.id} завершён!\n"
         f"<a href='{post_url}'>Ссылка на результаты</a>\n"
     )
-    await bot.send_message(chat_id=giveaway.user_id, text=text)
+    await bot.send_message(chat_id=giveaway.user_id, text=text,
+                           reply_markup=await get_callback_btns(
+                               btns={"Доставка уведомлений победителям": f"winners_delivery_{giveaway.id}"}))
 
 
-async def update_button_text(session: AsyncSession, giveaway_id: int) -> InlineKeyboardMarkup | None:
-    giveaway = await orm_get_giveaway_by_id(session=session, giveaway_id=giveaway_id)
-    if not giveaway:
-        return None
-    participants_count = await redis_get_participants_count(giveaway_id)
-    button_text = f"{giveaway.button} ({participants_count})"
-    buttons = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=button_text, url=f"{await join_giveaway_link(giveaway.id)}")]
+async def giveaway_button_markup(giveaway_id: int, button: str, participants_count: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{button} ({participants_count})", url=f"{await join_giveaway_link(giveaway_id)}")]
     ])
-    return buttons
 
 
+# Возвращает False, если пост розыгрыша удалён или недоступен
+@outbound_lane(Lane.GIVEAWAY)
+async def edit_giveaway_button(giveaway_id: int, chat_id: int, message_id: int, button: str,
+                               participants_count: int) -> bool:
+    try:
+        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id,
+                                            reply_markup=await giveaway_button_markup(giveaway_id, button,
+                                                                                      participants_count))
+    except TelegramBadRequest as e:
+        if "exactly the same" in str(e):
+            return True
+        elif "message to edit not found" in str(e) or "MESSAGE_ID_INVALID" in str(e):
+            await post_deleted(giveaway_id=giveaway_id)
+            return False
+        channel = await channel_info(chat_id)
+        await send_log(text=f"Error while updating button for giveaway:\n/usergive{giveaway_id}"
+                            f"\n{channel.title if channel else chat_id} {channel.invite_link if channel else ''}"
+                            f"\n\n{e}")
+    except TelegramForbiddenError as e:
+        channel = await channel_info(chat_id)
+        await send_log(text=f"Error while updating button for giveaway:\n/usergive{giveaway_id}"
+                            f"\n{channel.title if channel else chat_id} "
+                            f"{channel.invite_link if channel else ''}\n\n"
+                            f"{e}")
+        return False
+    return True
+
+
+@outbound_lane(Lane.GIVEAWAY)
 async def update_giveaway_message(session: AsyncSession, giveaway_id: int, chat_id: int, message_id: int):
-    new_buttons = await update_button_text(session, giveaway_id)
-    channel = await channel_info(chat_id)
-    if new_buttons:
-        try:
-            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=new_buttons)
-            await asyncio.sleep(1 / 20)
-        except TelegramBadRequest as e:
-            if "exactly the same" in str(e):
-                pass
-            elif "message to edit not found" or "MESSAGE_ID_INVALID" in str(e):
-                await post_deleted(giveaway_id=giveaway_id)
-            else:
-                await send_log(text=f"Error while updating button for giveaway:\n/usergive{giveaway_id}"
-                                    f"\n{channel.title} {channel.invite_link}\n\n{e}")
-        except TelegramForbiddenError as e:
-            await send_log(text=f"Error while updating button for giveaway:\n/usergive{giveaway_id}"
-                                f"\n{channel.title if channel else chat_id} "
-                                f"{channel.invite_link if channel else ''}\n\n"
-                                f"{e}")
-
-
-async def add_participant_to_redis(giveaway_id: int, user_id: int):
-    await redis_add_participant(giveaway_id, user_id)
+    giveaway = await get_giveaway_info(session=session, giveaway_id=giveaway_id)
+    if not giveaway:
+        return
+    participants_count = await redis_get_participants_count(giveaway_id)
+    await edit_giveaway_button(giveaway_id, chat_id, message_id, giveaway.button, participants_count)
 
 
 # Можно ускорить(по запросу)
@@ -258,9 +303,9 @@ async def check_giveaway_text(session: AsyncSession, giveaway_id: int) -> str |
 
         # Добавляем результаты конкурса
         c = 0
-        for winner_id in giveaway.winner_ids:
+        for winner_creds in await get_users_creds(giveaway.winner_ids or []):
             c += 1
-            winner_text = f"{c}.{await get_user_creds(winner_id)}\n"
+            winner_text = f"{c}.{winner_creds}\n"
             if len(text) + len(winner_text) > limit:
                 if not messages:
                     messages.append(initial_text + text)
@@ -282,17 +327,7 @@ async def get_giveaway_post(giveaway, user_id):
     text += "\n\n<b>Условия участия:</b>\n\n"
     message = None
 
-    if not giveaway.sponsor_channel_ids or giveaway.channel_id not in giveaway.sponsor_channel_ids:
-        channel = await channel_info(channel_id=giveaway.channel_id)
-        text += await channel_conditions_text(channel)
-
-    if giveaway.sponsor_channel_ids:
-        for channel_id in giveaway.sponsor_channel_ids:
-            try:
-                channel = await channel_info(channel_id=channel_id)
-                text += await channel_conditions_text(channel)
-            except TelegramBadRequest:
-                text += f"✅ Подпишись на (бота удалили из канала)\n"
+    text += await conditions_channels_text(giveaway.channel_id, giveaway.sponsor_channel_ids)
 
     if giveaway.extra_conditions:
         text += f"\n{giveaway.extra_conditions}\n\n"
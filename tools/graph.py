@@ -5,7 +5,8 @@ import matplotlib.patches as mpatches
 import matplotlib.pyplot as plt
 
 
-async def create_graph(data):
+async def create_graph(data, title: str = 'Активность регистрации пользователей по месяцам',
+                       ylabel: str = 'Количество новых пользователей', show_total: bool = True):
     months, user_counts = zip(*data)
     fig, ax = plt.subplots(figsize=(15, 8))
 
@@ -33,8 +34,8 @@ async def create_graph(data):
     ax.set_xticklabels([month.strftime('%Y-%m') for month in months], rotation=0, ha='center')
 
     plt.xlabel('Месяц')
-    plt.ylabel('Количество новых пользователей')
-    plt.title('Активность регистрации пользователей по месяцам')
+    plt.ylabel(ylabel)
+    plt.title(title)
 
     # Добавление аннотаций
     for month, user_count in zip(months, user_counts):
@@ -44,10 +45,10 @@ async def create_graph(data):
     total_users = sum(user_counts)
 
     # Создание отдельного объекта для общего количества пользователей
-    total_patch = mpatches.Patch(color='none', label=f'Всего пользователей: {total_users}')
+    total_patch = [mpatches.Patch(color='none', label=f'Всего пользователей: {total_users}')] if show_total else []
 
     # Добавление общего количества пользователей и легенды с месяцами в самый угол изображения
-    ax.legend(handles=[total_patch] + [
+    ax.legend(handles=total_patch + [
         mpatches.Patch(color=cmap(i / len(months)), label=f'{month.strftime("%Y-%m")}: {user_count}') for
         i, (month, user_count) in enumerate(zip(months, user_counts))],
               loc='upper left', bbox_to_anchor=(-0.31, 1.1), fontsize=10, title='Статистика')
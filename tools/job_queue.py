@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Awaitable, Callable
+
+from decouple import config
+
+from db.r_engine import instance_id
+from db.r_operations import redis_create_job_group, redis_add_job, redis_read_jobs, redis_claim_stale_jobs, \
+    redis_finish_job, redis_retry_job, redis_dead_letter_job, redis_move_due_jobs, redis_touch_job
+from tools.logs_channel import send_log
+
+logger = logging.getLogger(__name__)
+
+job_workers = config("JOB_WORKERS", default=4, cast=int)
+job_max_attempts = config("JOB_MAX_ATTEMPTS", default=5, cast=int)
+# Задержка перед первым повтором, дальше удваивается
+job_retry_delay = config("JOB_RETRY_DELAY", default=5, cast=float)
+# Задачу, исполнитель которой не продлевал её это время (например, упал), забирает другой исполнитель
+job_claim_idle = config("JOB_CLAIM_IDLE", default=900, cast=float)
+
+job_handlers: dict[str, Callable[..., Awaitable]] = {}
+
+
+def job_handler(job_type: str):
+    """Registers the decorated coroutine as the handler of job_type jobs; keyword arguments come from the job."""
+
+    def decorator(func):
+        job_handlers[job_type] = func
+        return func
+
+    return decorator
+
+
+async def enqueue_job(job_type: str, **kwargs):
+    await redis_add_job(json.dumps({"type": job_type, "kwargs": kwargs, "attempt": 0}))
+
+
+# Пока задача выполняется, её время простоя сбрасывается: долгую задачу не заберёт второй исполнитель
+async def keep_job_claimed(entry_id: str):
+    while True:
+        await asyncio.sleep(job_claim_idle / 3)
+        try:
+            await redis_touch_job(entry_id, instance_id)
+        except Exception as e:
+            logger.warning(f"Failed to refresh job {entry_id}: {e}")
+
+
+async def process_job(entry_id: str, data: str):
+    job = json.loads(data)
+    handler = job_handlers.get(job["type"])
+    heartbeat = asyncio.create_task(keep_job_claimed(entry_id))
+    try:
+        if handler is None:
+            raise LookupError(f"Unknown job type: {job['type']}")
+        await handler(**job["kwargs"])
+    except Exception as e:
+        job["attempt"] += 1
+        job["error"] = repr(e)
+        if handler is None or job["attempt"] >= job_max_attempts:
+            await redis_dead_letter_job(entry_id, json.dumps(job))
+            await send_log(text=f"Задача {job['type']} {job['kwargs']} не выполнена "
+                                f"после {job['attempt']} попыток:\n\n{e}")
+        else:
+            retry_at = time.time() + job_retry_delay * 2 ** (job["attempt"] - 1)
+            await redis_retry_job(entry_id, json.dumps(job), retry_at)
+        return
+    finally:
+        heartbeat.cancel()
+    await redis_finish_job(entry_id)
+
+
+async def job_worker():
+    while True:
+        try:
+            for entry_id, data in await redis_read_jobs(instance_id):
+                await process_job(entry_id, data)
+        except Exception as e:
+            logger.warning(f"Job worker error: {e}")
+            await asyncio.sleep(1)
+
+
+# Повторы по расписанию и задачи упавших исполнителей
+async def job_maintenance():
+    while True:
+        try:
+            await redis_move_due_jobs()
+            for entry_id, data in await redis_claim_stale_jobs(instance_id, job_claim_idle):
+                await process_job(entry_id, data)
+        except Exception as e:
+            logger.warning(f"Job maintenance error: {e}")
+        await asyncio.sleep(1)
+
+
+async def run_job_workers():
+    await redis_create_job_group()
+    await asyncio.gather(job_maintenance(), *(job_worker() for _ in range(job_workers)))
@@ -1,12 +1,11 @@
-import asyncio
-
 from decouple import config
 
 from create_bot import bot
+from middlewares.rate_limit import outbound_lane, Lane
 
 logs_channel_id = int(config("LOGS_CHANNEL_ID"))
 
 
+@outbound_lane(Lane.LOGS)
 async def send_log(text: str):
-    await asyncio.sleep(1 / 20)
     await bot.send_message(chat_id=logs_channel_id, text=text)
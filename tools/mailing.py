@@ -2,20 +2,36 @@ import asyncio
 import datetime
 import logging
 import re
+from typing import Awaitable, Callable
 
 import tqdm
+from decouple import config
 
 from create_bot import bot
-from db.r_operations import redis_delete_mailing_user, redis_get_mailing_users, redis_get_mailing_msg, \
-    redis_get_msg_from, \
-    redis_get_mailing_btns
+from db.pg_engine import unit_of_work
+from db.pg_orm_query import orm_mailing_off_bulk
+from db.r_engine import instance_id
+from db.r_operations import redis_get_mailing_users_count, redis_pop_mailing_users, redis_restore_mailing_users, \
+    redis_get_mailing_msg, redis_get_msg_from, redis_get_mailing_btns, redis_get_mailing_stats, \
+    redis_start_mailing_stats, redis_mailing_checkpoint, redis_finish_mailing_stats, redis_acquire_lock, \
+    redis_extend_lock, redis_release_lock, redis_clear_mailing
 from keyboards.inline import get_callback_btns
 from loggers.setup_logger import module_logger
+from middlewares.rate_limit import outbound_lane, Lane
+from tools.utils import known_users
 
 logger_name = "tools.mailing"
 logger = logging.getLogger(logger_name)
 module_logger(logger_name, "logs_mailing", "mailing.log", logging.INFO, console=True, detail=False)
 
+mailing_concurrency = config("MAILING_CONCURRENCY", default=10, cast=int)
+# Сколько обработанных получателей копится перед записью чекпоинта в Redis
+mailing_checkpoint_size = config("MAILING_CHECKPOINT_SIZE", default=100, cast=int)
+# Размер пачки получателей, которая читается из Postgres и забирается из Redis за один запрос
+mailing_chunk_size = config("MAILING_CHUNK_SIZE", default=1000, cast=int)
+# Рассылку ведёт одна реплика: блокировка продлевается, пока рассылка идёт
+mailing_lock_ttl = 30
+
 
 async def format_timedelta(td, lang="en"):
     translations = {
@@ -45,65 +61,145 @@ async def format_timedelta(td, lang="en"):
     return " ".join(parts)
 
 
-async def simple_mailing():
-    logger.info("=== MAILING STARTED ===")
+async def mailing_progress_text(done: int, total_users: int) -> str:
+    progress = done / total_users * 100 if total_users else 100
+    bar_length = 10
+    filled_length = int(bar_length * done // total_users) if total_users else bar_length
+    bar = "🟩" * filled_length + "⬜️" * (bar_length - filled_length)
+    return f"Прогресс рассылки:\n{progress:.2f}%|{bar}|\n{done}/{total_users}"
+
+
+async def mailing_report_text(success: int, notsuccess: int, blocked: int, elapsed_time_str: str,
+                              reclaimed: int = 0) -> str:
+    if elapsed_time_str == "":
+        elapsed_time_str = "менее секунды"
+    text = (f"Рассылка успешна.\n\nРезультаты:\nУспешно - {success}\nНеудачно - {notsuccess}\n\n"
+            f"Затрачено времени: <b>{elapsed_time_str}</b>\n\n"
+            f"<span class='tg-spoiler'>Бот заблокирован у {blocked} пользователя(ей)</span>")
+    if reclaimed:
+        text += f"\n\nРассылка отключена для {reclaimed} пользователя(ей), они не попадут в следующие рассылки"
+    return text
+
+
+async def keep_mailing_lock():
+    while True:
+        await asyncio.sleep(mailing_lock_ttl / 3)
+        await redis_extend_lock("lock:mailing", instance_id, mailing_lock_ttl)
+
 
-    users = await redis_get_mailing_users()
+@outbound_lane(Lane.MAILING)
+async def simple_mailing(prepare: Callable[[], Awaitable] = None, resume: bool = False):
+    """
+    Returns None if another replica is already sending a mailing.
+    prepare() fills the audience and the message keys in Redis and runs only while the lock is held.
+    """
+    if not await redis_acquire_lock("lock:mailing", instance_id, mailing_lock_ttl):
+        return None
+    lock_task = asyncio.create_task(keep_mailing_lock())
+    try:
+        if prepare is not None:
+            await prepare()
+        return await _simple_mailing(resume)
+    finally:
+        lock_task.cancel()
+        await redis_release_lock("lock:mailing", instance_id)
+
+
+async def _simple_mailing(resume: bool):
+    logger.info("=== MAILING RESUMED ===" if resume else "=== MAILING STARTED ===")
+
+    if resume:
+        await redis_restore_mailing_users()
     msg_id = await redis_get_mailing_msg()
     ch_id = await redis_get_msg_from()
     btns: dict = await redis_get_mailing_btns()
-    total_users = len(users)
+    reply_markup = await get_callback_btns(btns=btns) if btns else None
 
-    pbar = tqdm.tqdm(total=total_users, desc="Mailing progress")
-    progress_text = f"Прогресс рассылки:\n0%|{"⬜️" * 10}|\n{pbar.n}/{total_users}"
-    progress_msg = await bot.send_message(chat_id=ch_id, text=f"{progress_text}")
+    # Счётчики хранятся в Redis, чтобы после перезапуска продолжить рассылку с того же места
+    stats = await redis_get_mailing_stats() if resume else {}
+    if not stats:
+        stats = await redis_start_mailing_stats(total=await redis_get_mailing_users_count())
+    total_users = stats["total"]
+    counters = {"success": stats["success"], "notsuccess": stats["notsuccess"], "blocked": stats["blocked"]}
+    reclaimed = stats.get("reclaimed", 0)
+    start_time = datetime.datetime.fromtimestamp(stats["started"])
+
+    pbar = tqdm.tqdm(total=total_users, initial=sum(counters.values()), desc="Mailing progress")
+    progress_msg = await bot.send_message(chat_id=ch_id, text=await mailing_progress_text(pbar.n, total_users))
     prgss_msg_id = progress_msg.message_id
 
-    start_time = datetime.datetime.now()
-    last_update_time = start_time
+    queue = asyncio.Queue(maxsize=mailing_chunk_size)
+    checkpoint = {"users": [], "optout": [], "success": 0, "notsuccess": 0, "blocked": 0}
 
-    success, notsuccess, blocked = 0, 0, 0
+    async def flush_checkpoint():
+        nonlocal reclaimed
+        if not checkpoint["users"]:
+            return
+        processed, optout = checkpoint["users"], checkpoint["optout"]
+        increments = {key: checkpoint[key] for key in counters}
+        checkpoint.update(users=[], optout=[], success=0, notsuccess=0, blocked=0)
+        # Заблокировавшим бота и удалённым аккаунтам рассылка отключается, чтобы не тратить на них следующие рассылки
+        if optout:
+            # Сбой базы не должен останавливать рассылку: эти пользователи просто останутся в списке
+            try:
+                async with unit_of_work() as session:
+                    increments["reclaimed"] = await orm_mailing_off_bulk(session, optout)
+            except Exception as e:
+                logger.warning(f"Failed to turn off mailing for {len(optout)} users: {e!r}")
+            else:
+                reclaimed += increments["reclaimed"]
+                # Иначе повторный /start не дойдёт до базы и не включит рассылку обратно
+                for user_id in optout:
+                    known_users.pop(user_id)
+        await redis_mailing_checkpoint(processed, increments)
 
-    for user in users:
-        try:
-            if btns:
+    async def producer():
+        while users := await redis_pop_mailing_users(mailing_chunk_size):
+            for user in users:
+                await queue.put(user)
+        for _ in range(mailing_concurrency):
+            await queue.put(None)
+
+    async def sender():
+        while (user := await queue.get()) is not None:
+            try:
                 await bot.copy_message(chat_id=str(user), from_chat_id=str(ch_id), message_id=str(msg_id),
-                                       reply_markup=await get_callback_btns(btns=btns))
-            else:
-                await bot.copy_message(chat_id=str(user), from_chat_id=str(ch_id), message_id=str(msg_id))
-            # logger.info(f"Sent message to {user}")
-            success += 1
-            await redis_delete_mailing_user(user)
-        except Exception as e:
-            error_message = str(e)
-            if re.search(r"Forbidden: bot was blocked by the user", error_message):
-                # logger.warning(f"User {user} blocked the bot. Removing from mailing list.")
-                await redis_delete_mailing_user(user)
-                blocked += 1
-            else:
-                # logger.error(f"Failed to send message to {user}: {e}")
-                await redis_delete_mailing_user(user)
-                notsuccess += 1
+                                       reply_markup=reply_markup)
+                result = "success"
+            except Exception as e:
+                if re.search(r"Forbidden: (bot was blocked by the user|user is deactivated)", str(e)):
+                    result = "blocked"
+                    checkpoint["optout"].append(user)
+                else:
+                    result = "notsuccess"
+            counters[result] += 1
+            checkpoint[result] += 1
+            checkpoint["users"].append(user)
+            pbar.update(1)
+            if len(checkpoint["users"]) >= mailing_checkpoint_size:
+                await flush_checkpoint()
 
-        pbar.update(1)
-        await asyncio.sleep(1 / 20)
-        """
-        For 09.2024 Telegram API limit is 30 messages per second
-        Tests on local machine showed these results for 150 messages:
-        1/10 = 25s
-        1/15 = 26s
-        1/20 = 27s
-        1/25 = 29s
-        1/30 = >29s
-        """
-        if (datetime.datetime.now() - last_update_time).total_seconds() >= 1:
-            progress = pbar.n / total_users * 100
-            bar_length = 10
-            filled_length = int(bar_length * pbar.n // total_users)
-            bar = "🟩" * filled_length + "⬜️" * (bar_length - filled_length)
-            progress_text = f"Прогресс рассылки:\n{progress:.2f}%|{bar}|\n{pbar.n}/{total_users}"
-            await bot.edit_message_text(chat_id=ch_id, message_id=prgss_msg_id, text=progress_text)
-            last_update_time = datetime.datetime.now()
+    async def report_progress():
+        last_text = None
+        while True:
+            await asyncio.sleep(1)
+            progress_text = await mailing_progress_text(pbar.n, total_users)
+            if progress_text == last_text:
+                continue
+            try:
+                await bot.edit_message_text(chat_id=ch_id, message_id=prgss_msg_id, text=progress_text)
+                last_text = progress_text
+            except Exception as e:
+                logger.warning(f"Failed to update mailing progress: {e}")
+
+    progress_task = asyncio.create_task(report_progress())
+    try:
+        await asyncio.gather(producer(), *(sender() for _ in range(mailing_concurrency)))
+    finally:
+        progress_task.cancel()
+        await flush_checkpoint()
+    await redis_finish_mailing_stats()
+    success, notsuccess, blocked = counters["success"], counters["notsuccess"], counters["blocked"]
 
     end_time = datetime.datetime.now()
     elapsed_time = end_time - start_time
@@ -113,15 +209,34 @@ async def simple_mailing():
 
     logger.info("=== MAILING FINISHED ===")
     logger.info(
-        f"Sent messages to {success}, failed to send to {notsuccess}, bot blocked by {blocked}. "
-        f"Time taken: {elapsed_time_str}"
+        f"Sent messages to {success}, failed to send to {notsuccess}, bot blocked by {blocked}, "
+        f"mailing turned off for {reclaimed}. Time taken: {elapsed_time_str}"
     )
     elapsed_time_str_ru = await format_timedelta(elapsed_time, lang="ru")
     pbar.close()
     await bot.delete_message(chat_id=ch_id, message_id=prgss_msg_id)
-    return success, notsuccess, blocked, elapsed_time_str_ru
+    return success, notsuccess, blocked, reclaimed, elapsed_time_str_ru
+
+
+# Продолжает рассылку, прерванную перезапуском бота, и отправляет отчёт её автору
+async def resume_mailing():
+    if not await redis_get_mailing_stats():
+        return
+    if await redis_get_mailing_msg() is None:
+        # Сообщение истекло: продолжать нечего, очередь получателей больше не нужна
+        logger.warning("Mailing message expired, unfinished mailing is dropped")
+        await redis_clear_mailing()
+        return
+    ch_id = await redis_get_msg_from()
+    result = await simple_mailing(resume=True)
+    if result is None:
+        return
+    success, notsuccess, blocked, reclaimed, elapsed_time_str = result
+    await bot.send_message(chat_id=ch_id,
+                           text=await mailing_report_text(success, notsuccess, blocked, elapsed_time_str, reclaimed))
 
 
+@outbound_lane(Lane.MAILING)
 async def simple_mailing_test(users: list[int], btns: dict = None, msg_id: int = None, ch_id: int = None):
     logger.info("=== MAILING TEST STARTED ===")
 
@@ -159,16 +274,6 @@ async def simple_mailing_test(users: list[int], btns: dict = None, msg_id: int =
                 notsuccess += 1
 
         pbar.update(1)
-        await asyncio.sleep(1 / 20)
-        """
-        For 09.2024 Telegram API limit is 30 messages per second
-        Tests on local machine showed these results for 150 messages:
-        1/10 = 25s
-        1/15 = 26s
-        1/20 = 27s
-        1/25 = 29s
-        1/30 = >29s
-        """
         if (datetime.datetime.now() - last_update_time).total_seconds() >= 1:
             progress = pbar.n / total_users * 100
             bar_length = 10
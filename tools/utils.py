@@ -1,19 +1,48 @@
 import asyncio
 import re
 import traceback
+from functools import partial
+from typing import Awaitable, Callable, NamedTuple
 
 from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
-from aiogram.types import Message
+from aiogram.types import Message, User
+from decouple import config
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from create_bot import bot, env_admins
-from db.pg_engine import session_maker
+from db.pg_engine import unit_of_work, after_commit
 from db.pg_models import GiveawayStatus
-from db.pg_orm_query import orm_get_giveaways_by_sponsor_channel_id, orm_update_giveaway_status, orm_delete_channel, \
-    orm_get_user_id_by_giveaway_id, orm_delete_sponsor, orm_get_sponsors_count
-from db.r_operations import redis_get_participants_count
+from db.pg_orm_query import orm_get_giveaways_by_sponsor_channel_id, orm_delete_channel, \
+    orm_get_user_id_by_giveaway_id, orm_get_sponsors_count, orm_upsert_user
+from db.r_operations import redis_get_participants_count, redis_get_subscriptions, redis_set_subscription
+from tools.cache import TTLCache
+from tools.giveaway_changes import update_giveaway_status, delete_sponsor
 from tools.logs_channel import send_log
 
-session = session_maker()
+# Статус подписки (channel_id, user_id): локальный LRU перед общим кэшем в Redis
+subscription_ttl = config("SUBSCRIPTION_CACHE_TTL", default=300, cast=int)
+subscription_negative_ttl = config("SUBSCRIPTION_CACHE_NEGATIVE_TTL", default=10, cast=int)
+subscription_cache = TTLCache(maxsize=config("SUBSCRIPTION_CACHE_SIZE", default=50000, cast=int),
+                              ttl=subscription_ttl)
+subscription_stats = {"redis_hits": 0, "telegram_requests": 0}
+
+# Пользователи, уже записанные в базу, с их username и именем: повторный /start не обращается к базе.
+# Рассылка сбрасывает отключённых пользователей только в своей реплике, остальные - через KNOWN_USERS_CACHE_TTL
+known_users = TTLCache(maxsize=config("KNOWN_USERS_CACHE_SIZE", default=100000, cast=int),
+                       ttl=config("KNOWN_USERS_CACHE_TTL", default=3600, cast=int))
+
+
+class ChatInfo(NamedTuple):
+    id: int
+    title: str | None
+    invite_link: str | None
+    username: str | None
+    first_name: str | None
+
+
+# Кэш get_chat для каналов и пользователей; размер ограничен количеством записей
+chat_cache = TTLCache(maxsize=config("CHAT_CACHE_SIZE", default=10000, cast=int),
+                      ttl=config("CHAT_CACHE_TTL", default=600, cast=int))
 
 
 async def get_bot_link_to_start() -> str:
@@ -30,12 +59,42 @@ async def msg_to_cbk(message: Message):
     return clean_buttons
 
 
-async def is_subscribed(channels: list, user_id: int) -> bool:
-    for channel in channels:
-        channel_id = channel.channel_id if hasattr(channel, 'channel_id') else channel
+# before_request ожидается перед каждым запросом к Telegram, ответы из кэша его не тратят
+async def is_subscribed(channels: list, user_id: int,
+                        before_request: Callable[[], Awaitable] | None = None) -> bool:
+    channel_ids = [channel.channel_id if hasattr(channel, 'channel_id') else channel for channel in channels]
+    not_cached = []
+    for channel_id in channel_ids:
+        subscribed = subscription_cache.get((channel_id, user_id))
+        if subscribed is False:
+            return False
+        if subscribed is None:
+            not_cached.append(channel_id)
+    if not not_cached:
+        return True
+
+    to_check = []
+    for channel_id, subscribed in zip(not_cached, await redis_get_subscriptions(not_cached, user_id)):
+        if subscribed is None:
+            to_check.append(channel_id)
+            continue
+        subscription_stats["redis_hits"] += 1
+        subscription_cache.set((channel_id, user_id), subscribed,
+                               ttl=subscription_ttl if subscribed else subscription_negative_ttl)
+        if not subscribed:
+            return False
+
+    for channel_id in to_check:
+        if before_request is not None:
+            await before_request()
+        subscription_stats["telegram_requests"] += 1
         try:
             chat_member = await bot.get_chat_member(channel_id, user_id)
-            if chat_member.status in ["restricted", "left", "kicked"]:
+            subscribed = chat_member.status not in ["restricted", "left", "kicked"]
+            ttl = subscription_ttl if subscribed else subscription_negative_ttl
+            subscription_cache.set((channel_id, user_id), subscribed, ttl=ttl)
+            await redis_set_subscription(channel_id, user_id, subscribed, ttl)
+            if not subscribed:
                 return False
         except TelegramBadRequest as e:
             if "member list is inaccessible" in str(e):
@@ -77,10 +136,59 @@ async def is_admin(user_id: int) -> bool:
     return is_env_admin
 
 
+async def _fetch_chat_info(chat_id: int) -> ChatInfo:
+    chat = await bot.get_chat(chat_id)
+    info = ChatInfo(id=chat.id, title=chat.title, invite_link=chat.invite_link, username=chat.username,
+                    first_name=chat.first_name)
+    chat_cache.set(chat_id, info)
+    return info
+
+
+async def get_chat_info(chat_id: int) -> ChatInfo:
+    info = chat_cache.get(chat_id)
+    if info is None:
+        info = await _fetch_chat_info(chat_id)
+    return info
+
+
+# Пакетное получение: из кэша сразу, остальные параллельно. При ошибке Telegram значение None
+async def get_many_chats_info(chat_ids: list[int]) -> dict[int, ChatInfo | None]:
+    result = {}
+    missing = []
+    for chat_id in dict.fromkeys(chat_ids):
+        info = chat_cache.get(chat_id)
+        if info is None:
+            missing.append(chat_id)
+        else:
+            result[chat_id] = info
+    semaphore = asyncio.Semaphore(10)
+
+    async def fetch(chat_id: int):
+        async with semaphore:
+            return await _fetch_chat_info(chat_id)
+
+    fetched = await asyncio.gather(*(fetch(chat_id) for chat_id in missing), return_exceptions=True)
+    errors = []
+    for chat_id, info in zip(missing, fetched):
+        if isinstance(info, Exception):
+            # TelegramBadRequest - чат удалён или недоступен, остальное (сеть, Forbidden, flood) стоит показать
+            if not isinstance(info, TelegramBadRequest):
+                errors.append(f"{chat_id}: {info!r}")
+            info = None
+        result[chat_id] = info
+    if errors:
+        await send_log(f"Не удалось получить данные {len(errors)} чатов:\n\n" + "\n".join(errors[:10]))
+    return result
+
+
+# Сбрасывает только кэш этой реплики: остальные увидят изменения чата не позже чем через CHAT_CACHE_TTL
+def invalidate_chat_info(chat_id: int):
+    chat_cache.pop(chat_id)
+
+
 async def channel_info(channel_id: int):
     try:
-        await asyncio.sleep(1/20)
-        chat = await bot.get_chat(channel_id)
+        chat = await get_chat_info(channel_id)
         if chat.invite_link is not None:
             return chat
         else:
@@ -92,6 +200,20 @@ async def channel_info(channel_id: int):
         return None
 
 
+async def channels_info(channel_ids: list[int]) -> list[ChatInfo | None]:
+    chats = await get_many_chats_info(channel_ids)
+    return [chat if chat is not None and chat.invite_link is not None else None
+            for chat in (chats[channel_id] for channel_id in channel_ids)]
+
+
+async def save_user(session: AsyncSession, user: User):
+    profile = (user.username, user.full_name)
+    if known_users.get(user.id) == profile:
+        return
+    await orm_upsert_user(session, user.id, user.username, user.full_name)
+    after_commit(session, partial(known_users.set, user.id, profile))
+
+
 async def not_admin(chat_id: int, user_id: int = None):
     text = (f"{await get_user_creds(user_id)} удалил меня из канала/группы {chat_id}!\n"
             f"Канал удалён из базы данных.\n"
@@ -104,17 +226,21 @@ async def not_admin(chat_id: int, user_id: int = None):
         # await send_log(f"Error in utils.py:93: {e}")
         pass
     try:
-        giveaways_ids = await orm_get_giveaways_by_sponsor_channel_id(session, chat_id)
-        for giveaway in giveaways_ids:
-            if await orm_get_sponsors_count(session, giveaway) > 1:
-                await orm_delete_sponsor(session, giveaway, chat_id)
-                await send_log(text=f"Спонсор {chat_id} был удалён из розыгрыша #{giveaway}")
-            else:
-                participants_count = await redis_get_participants_count(giveaway)
-                await orm_update_giveaway_status(session, giveaway, GiveawayStatus.FINISHED,
+        logs = []
+        async with unit_of_work() as session:
+            giveaways_ids = await orm_get_giveaways_by_sponsor_channel_id(session, chat_id)
+            for giveaway in giveaways_ids:
+                if await orm_get_sponsors_count(session, giveaway) > 1:
+                    await delete_sponsor(session, giveaway, chat_id)
+                    logs.append(f"Спонсор {chat_id} был удалён из розыгрыша #{giveaway}")
+                else:
+                    participants_count = await redis_get_participants_count(giveaway)
+                    await update_giveaway_status(session, giveaway, GiveawayStatus.FINISHED,
                                                  participants_count=participants_count)
-                await send_log(text=f"Розыгрыш #{giveaway} завершён принудительно, так как удалён последний спонсор.")
-        await orm_delete_channel(session, chat_id)
+                    logs.append(f"Розыгрыш #{giveaway} завершён принудительно, так как удалён последний спонсор.")
+            await orm_delete_channel(session, chat_id)
+        for text in logs:
+            await send_log(text=text)
     except Exception:
         error_traceback = traceback.format_exc()
         print(f"Ошибка в функции not_admin:\n {error_traceback}")
@@ -122,12 +248,13 @@ async def not_admin(chat_id: int, user_id: int = None):
 
 async def post_deleted(giveaway_id: int):
     try:
-        user_id = await orm_get_user_id_by_giveaway_id(session, giveaway_id)
+        async with unit_of_work() as session:
+            user_id = await orm_get_user_id_by_giveaway_id(session, giveaway_id)
+            await update_giveaway_status(session, giveaway_id, GiveawayStatus.FINISHED)
         await bot.send_message(chat_id=user_id, text=f"Ты удалил пост розыгрыша №{giveaway_id}!\n"
                                                      f"Розыгрыш завершён принудительно "
                                                      f"без определения победителей.\n"
                                                      f"/mygive{giveaway_id}")
-        await orm_update_giveaway_status(session, giveaway_id, GiveawayStatus.FINISHED)
     except Exception as e:
         await send_log(f"ОШИБКА ПРИ УДАЛЕНИИ РОЗЫГРЫША:\n/usergive{giveaway_id}\n\n{e}")
 
@@ -138,12 +265,22 @@ async def remove_premium_emoji_tags(text: str) -> str:
     return cleaned_text
 
 
+def _user_creds_text(user_id: int, user: ChatInfo | None) -> str:
+    if user is None:
+        return f"<a href='tg://user?id={user_id}'>{user_id}</a>"
+    user_name = user.first_name if user.first_name else "No name"
+    user_username = f"@{user.username}" if user.username else f"{user.id}"
+    return f"<a href='tg://user?id={user.id}'>{user_name}</a> ({user_username})"
+
+
 async def get_user_creds(user_id: int) -> str:
     try:
-        user = await bot.get_chat(user_id)
-        user_name = user.first_name if user.first_name else "No name"
-        user_username = f"@{user.username}" if user.username else f"{user.id}"
-        text = f"<a href='tg://user?id={user.id}'>{user_name}</a> ({user_username})"
+        user = await get_chat_info(user_id)
     except Exception:
-        text = f"<a href='tg://user?id={user_id}'>{user_id}</a>"
-    return text
+        user = None
+    return _user_creds_text(user_id, user)
+
+
+async def get_users_creds(user_ids: list[int]) -> list[str]:
+    users = await get_many_chats_info(user_ids)
+    return [_user_creds_text(user_id, users[user_id]) for user_id in user_ids]
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import math
+import time
+
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from decouple import config
+
+from tools.logs_channel import send_log
+from tools.utils import is_subscribed
+
+logger = logging.getLogger(__name__)
+
+draw_concurrency = config("DRAW_CONCURRENCY", default=10, cast=int)
+# Бюджет запросов get_chat_member в секунду на один розыгрыш
+draw_requests_per_second = config("DRAW_REQUESTS_PER_SECOND", default=20, cast=float)
+# Во сколько раз больше кандидатов проверять за раз, чем осталось найти победителей
+draw_overfetch = config("DRAW_OVERFETCH", default=2, cast=float)
+# Повторы проверки кандидата при временных ошибках (сеть, 5xx Telegram, Redis)
+draw_check_retries = config("DRAW_CHECK_RETRIES", default=3, cast=int)
+
+
+class RateBudget:
+    def __init__(self, rate: float):
+        self._interval = 1 / rate if rate > 0 else 0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self, cost: int = 1):
+        async with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_slot)
+            self._next_slot = start + self._interval * cost
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+async def draw_winners(candidates: list[int], sponsor_channel_ids: list[int], winners_count: int,
+                       exclude=()) -> list[int]:
+    """
+    Returns the first winners_count subscribed users in the order of candidates (already shuffled by the caller),
+    checking them concurrently in batches so the result is the same as a sequential walk.
+    A candidate whose check keeps failing with a transient error fails the whole draw instead of being skipped.
+    """
+    channels = sponsor_channel_ids or []
+    excluded = set(exclude or ())
+    candidates = [user_id for user_id in candidates if user_id not in excluded]
+    semaphore = asyncio.Semaphore(draw_concurrency)
+    budget = RateBudget(draw_requests_per_second)
+
+    async def check(user_id: int) -> bool:
+        async with semaphore:
+            for attempt in range(draw_check_retries + 1):
+                try:
+                    # Бюджет тратят только запросы, дошедшие до Telegram, а не ответы из кэша подписок
+                    return await is_subscribed(channels, user_id, before_request=budget.wait)
+                except TelegramAPIError as e:
+                    if not isinstance(e, (TelegramNetworkError, TelegramServerError, TelegramRetryAfter)):
+                        # Окончательный ответ Telegram (например, бот удалён из канала): кандидат не проходит
+                        logger.warning(f"Subscription check of {user_id} failed: {e!r}")
+                        return False
+                    error = e
+                except Exception as e:
+                    error = e
+                logger.warning(f"Subscription check of {user_id} failed (attempt {attempt + 1}): {error!r}")
+                if attempt < draw_check_retries:
+                    await asyncio.sleep(2 ** attempt)
+            await send_log(text=f"Не удалось проверить подписку кандидата {user_id} при выборе победителей:\n\n"
+                                f"{error!r}")
+            raise error
+
+    winners = []
+    position = 0
+    while len(winners) < winners_count and position < len(candidates):
+        batch_size = max(draw_concurrency, math.ceil((winners_count - len(winners)) * draw_overfetch))
+        batch = candidates[position:position + batch_size]
+        position += len(batch)
+        # Временная ошибка не означает, что кандидат не подписан: она прерывает выбор, и задача повторяется
+        results = await asyncio.gather(*(check(user_id) for user_id in batch))
+        for user_id, eligible in zip(batch, results):
+            if eligible:
+                winners.append(user_id)
+                if len(winners) == winners_count:
+                    break
+    return winners